@@ -9,11 +9,21 @@ It includes options for displaying top predictions, confidence scores, and savin
 """
 
 import argparse
+import ast
+import collections
 import cv2
+import os
+import queue
+import shutil
+import subprocess
+import threading
 import time
 import numpy as np
-from ultralytics import YOLO
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from classification_utils import (AsyncVideoWriter, BufferPool, FFmpegWriter, StreamFilterBank,
+                                  create_temporal_filter, install_stop_handlers, stack_probabilities,
+                                  text_sprites, topk_classes)
 
 
 def parse_arguments():
@@ -21,22 +31,1065 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description="YOLOv8 real-time classification with webcam")
     parser.add_argument("--model", type=str, default="yolov8n-cls.pt", 
                         help="Model to use (yolov8n-cls.pt, yolov8s-cls.pt, yolov8m-cls.pt, yolov8l-cls.pt, yolov8x-cls.pt)")
-    parser.add_argument("--device", type=str, default="0", 
-                        help="Device to use (webcam index or video path)")
+    parser.add_argument("--backend", type=str, default="ultralytics", choices=["ultralytics", "onnxruntime", "opencv", "openvino"],
+                        help="Inference backend (the ONNX model is exported from --model on first use)")
+    parser.add_argument("--imgsz", type=int, default=224,
+                        help="Input size for exported backends")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="Intra-op threads for exported backends (0 uses the runtime default)")
+    parser.add_argument("--inter-op-threads", type=int, default=0,
+                        help="Inter-op threads for ONNX Runtime (0 uses the runtime default)")
+    parser.add_argument("--ov-hint", type=str, default="auto", choices=["auto", "latency", "throughput"],
+                        help="OpenVINO performance hint (auto: throughput for video files, latency for webcams)")
+    parser.add_argument("--ov-requests", type=int, default=0,
+                        help="Number of OpenVINO async infer requests (0 uses the device optimum)")
+    parser.add_argument("--quantize", type=str, default=None, choices=["int8"],
+                        help="Quantize the ONNX model, check it against FP32 and exit")
+    parser.add_argument("--calib-data", type=str, default="dataset/val",
+                        help="Calibration and check images laid out as <dir>/<class>/<image>")
+    parser.add_argument("--calib-images", type=int, default=200,
+                        help="Maximum number of images used for calibration")
+    parser.add_argument("--min-agreement", type=float, default=0.98,
+                        help="Top-1 agreement with FP32 required to accept the quantized model")
+    parser.add_argument("--device", type=str, nargs="+", default=["0"], 
+                        help="Devices to use (one or more webcam indices or video paths)")
     parser.add_argument("--conf", type=float, default=0.25, 
-                        help="Confidence threshold for predictions")
+                        help="Confidence threshold for predictions (frames below it go to --cascade-model)")
+    parser.add_argument("--cascade-model", type=str, default=None,
+                        help="Larger model for frames whose top-1 confidence is below --conf (e.g. yolov8m-cls.pt)")
+    parser.add_argument("--low-res-imgsz", type=int, default=0,
+                        help="Classify at this input size first and re-run uncertain frames at --imgsz (0 disables)")
+    parser.add_argument("--uncertainty", type=str, default="margin", choices=["margin", "entropy"],
+                        help="Uncertainty measure for the low-resolution pass")
+    parser.add_argument("--uncertainty-threshold", type=float, default=0.2,
+                        help="Re-run when the top-1/top-2 margin is below, or the normalized entropy above, this value")
     parser.add_argument("--save", action="store_true", 
                         help="Save the output video")
+    parser.add_argument("--headless", action="store_true",
+                        help="Run without a display window, until the sources end or SIGINT/SIGTERM")
+    parser.add_argument("--display-fps", type=float, default=30.0,
+                        help="Maximum refresh rate of the display window")
+    parser.add_argument("--writer", type=str, default="opencv", choices=["opencv", "ffmpeg"],
+                        help="Video encoder for --save: OpenCV's mp4v or an ffmpeg subprocess")
+    parser.add_argument("--ffmpeg-codec", type=str, default="libx264",
+                        help="ffmpeg video codec (libx264, libx265, h264_nvenc, ...)")
+    parser.add_argument("--ffmpeg-preset", type=str, default="veryfast",
+                        help="ffmpeg encoder preset (empty to use the codec default)")
+    parser.add_argument("--ffmpeg-crf", type=int, default=23,
+                        help="ffmpeg constant rate factor, lower is better quality (-1 to use the codec default)")
+    parser.add_argument("--ffmpeg-threads", type=int, default=0,
+                        help="ffmpeg encoder threads (0 lets ffmpeg decide)")
+    parser.add_argument("--ffmpeg-size", type=str, default=None,
+                        help="Output resolution for the ffmpeg writer as WIDTHxHEIGHT (default: source size)")
+    parser.add_argument("--ffmpeg-fps", type=float, default=0,
+                        help="Output frame rate for the ffmpeg writer (0 keeps the source rate)")
+    parser.add_argument("--segment-seconds", type=float, default=0,
+                        help="Split saved video into segments of this many seconds (0 disables)")
+    parser.add_argument("--segment-mb", type=float, default=0,
+                        help="Split saved video into segments of about this many megabytes (0 disables)")
+    parser.add_argument("--subtitles", type=str, default=None, choices=["vtt", "srt"],
+                        help="Write the top predictions as a WebVTT or SRT subtitle file instead of burning them in")
+    parser.add_argument("--mux-subtitles", action="store_true",
+                        help="Also copy a video file source and the subtitles into an .mkv, without re-encoding")
+    parser.add_argument("--predictions", type=str, default=None,
+                        help="Parquet file that receives every frame's top-k predictions (needs pyarrow)")
+    parser.add_argument("--predictions-row-group", type=int, default=65536,
+                        help="Rows buffered per Parquet row group")
+    parser.add_argument("--clip-classes", type=str, nargs="+", default=None,
+                        help="Record clips around frames where any of these classes (names or indices) is detected")
+    parser.add_argument("--clip-threshold", type=float, default=0.5,
+                        help="Probability a watched class needs to trigger a clip")
+    parser.add_argument("--pre-roll", type=float, default=5.0,
+                        help="Seconds of video kept in memory and written before a clip's trigger")
+    parser.add_argument("--post-roll", type=float, default=5.0,
+                        help="Seconds of video written after the last trigger of a clip")
+    parser.add_argument("--clip-jpeg-quality", type=int, default=90,
+                        help="JPEG quality of the frames held in the pre-roll buffer")
+    parser.add_argument("--writer-queue", type=int, default=16,
+                        help="Frames that may wait for the background video encoder")
+    parser.add_argument("--writer-policy", type=str, default="block", choices=["block", "drop", "keyframe"],
+                        help="What to do when the encoder falls behind: wait, drop frames, "
+                             "or keep only every --keyframe-interval-th frame while the queue is half full")
+    parser.add_argument("--keyframe-interval", type=int, default=30,
+                        help="Frames between the frames kept by --writer-policy keyframe")
     parser.add_argument("--show-fps", action="store_true", 
                         help="Display FPS counter")
     parser.add_argument("--top-k", type=int, default=3,
-                        help="Number of top predictions to display")
+                        help="Number of top predictions to display (any value up to the number of classes)")
+    parser.add_argument("--filter", type=str, default="ema", choices=["ema", "window", "vote", "hysteresis"],
+                        help="Temporal filter applied to the predictions of each stream")
+    parser.add_argument("--smoothing", type=float, default=0.7,
+                        help="EMA smoothing factor for the ema and hysteresis filters (higher = more smoothing)")
+    parser.add_argument("--window", type=int, default=10,
+                        help="Number of frames for the window and vote filters")
+    parser.add_argument("--hysteresis-margin", type=float, default=0.1,
+                        help="Probability lead a new label needs before the hysteresis filter switches to it")
     parser.add_argument("--custom-visualization", action="store_true", default=True,
                         help="Use custom visualization instead of built-in")
+    parser.add_argument("--capture-buffers", type=int, default=4,
+                        help="Number of preallocated frame buffers shared with the capture thread")
+    parser.add_argument("--latest-only", action="store_true",
+                        help="Always classify the freshest frame and drop stale ones (for live webcam sources)")
+    parser.add_argument("--gate-threshold", type=float, default=0.0,
+                        help="Skip inference when the mean thumbnail change (0-255) is below this value (0 disables)")
+    parser.add_argument("--frozen-frames", type=int, default=30,
+                        help="Consecutive identical frames after which the camera is reported as frozen")
+    parser.add_argument("--max-batch", type=int, default=8,
+                        help="Maximum number of frames classified in one model call")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0,
+                        help="Longest time a frame waits for its batch to fill before it is dispatched")
     return parser.parse_args()
 
 
-def custom_visualization(frame, results, top_k=3):
+class FrameRing:
+    """
+    Fixed pool of preallocated frame buffers shared by a producer and a consumer.
+    
+    Slots cycle between a free queue and a ready queue, so frames are decoded
+    straight into buffers that are reused for the whole run. In latest-only
+    mode stale ready slots are recycled instead of queued, and every recycled
+    slot is counted as a dropped frame.
+    """
+    
+    def __init__(self, first_frame, num_slots=4, latest_only=False):
+        # The first decoded frame becomes slot 0, the rest match its shape
+        self.frames = [first_frame] + [np.empty_like(first_frame) for _ in range(num_slots - 1)]
+        self.positions = [0.0] * num_slots  # Source time of each slot's frame in milliseconds
+        self.frame_numbers = [0] * num_slots  # Decode order of each slot's frame, counting dropped frames
+        self.latest_only = latest_only
+        self.ready = None  # Optional threading.Event set whenever a slot is published
+        self.dropped = 0
+        self._drop_lock = threading.Lock()
+        self._free = queue.Queue()
+        self._ready = queue.Queue()
+        for slot in range(1, num_slots):
+            self._free.put(slot)
+        self._ready.put(0)
+    
+    def acquire(self, timeout=None):
+        """Take a free slot for writing, or None if none became free in time."""
+        if self.latest_only:
+            # Never wait for the consumer: overwrite the oldest unread frame instead
+            try:
+                return self._free.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                slot = self._ready.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                self._count_drop()
+                return slot
+        
+        try:
+            return self._free.get(timeout=timeout)
+        except queue.Empty:
+            return None
+    
+    def publish(self, slot):
+        """Hand a filled slot to the consumer. None marks the end of the stream."""
+        self._ready.put(slot)
+        if self.ready is not None:
+            self.ready.set()
+    
+    def get(self, timeout=None):
+        """Take the next filled slot, blocking until one is published."""
+        slot = self._ready.get(timeout=timeout)
+        
+        # Skip ahead to the freshest frame, recycling the stale ones
+        while self.latest_only and slot is not None:
+            try:
+                newer = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            if newer is None:
+                # Return the last real frame first, end of stream on the next call
+                self._ready.put(None)
+                break
+            self.release(slot)
+            self._count_drop()
+            slot = newer
+        
+        return slot
+    
+    def release(self, slot):
+        """Return a consumed slot to the free pool."""
+        self._free.put(slot)
+    
+    def _count_drop(self):
+        with self._drop_lock:
+            self.dropped += 1
+
+
+class LatestFrame:
+    """
+    Single-frame mailbox from a fast producer to a slower consumer.
+    
+    The producer only copies a frame after the consumer has asked for one, so
+    frames nobody looks at cost nothing, and neither side ever waits. Two
+    buffers alternate, so the frame last returned by take() stays untouched
+    until take() is called again.
+    """
+    
+    def __init__(self):
+        self._front = None
+        self._back = None
+        self._fresh = False
+        self._wanted = True
+        self._lock = threading.Lock()
+    
+    def offer(self, frame):
+        """Copy the frame in if the consumer is waiting for a new one."""
+        if not self._wanted:
+            return
+        if self._back is None or self._back.shape != frame.shape:
+            self._back = np.empty_like(frame)
+        np.copyto(self._back, frame)
+        with self._lock:
+            self._front, self._back = self._back, self._front
+            self._fresh = True
+            self._wanted = False
+    
+    def take(self):
+        """Return the newest frame not taken yet, or None, and ask for the next one."""
+        with self._lock:
+            frame = self._front if self._fresh else None
+            self._fresh = False
+            self._wanted = True
+        return frame
+
+
+class CaptureThread(threading.Thread):
+    """
+    Background thread that decodes frames into a FrameRing.
+    
+    Decoding overlaps with inference in the main loop, and VideoCapture.read
+    writes into the preallocated slot instead of allocating a new frame.
+    """
+    
+    def __init__(self, cap, num_buffers=4, latest_only=False, preview=False):
+        super().__init__(daemon=True)
+        self.cap = cap
+        self.ring = None
+        self.preview = LatestFrame() if preview else None
+        self._stop_event = threading.Event()
+        
+        # Read the first frame synchronously to size the buffer pool
+        success, frame = cap.read()
+        if success:
+            # Latest-only needs a slot being written, one ready and one in use
+            min_buffers = 3 if latest_only else 2
+            self.ring = FrameRing(frame, max(num_buffers, min_buffers), latest_only)
+            self._first_frame_time = time.perf_counter()
+            self._frames_read = 1
+            self.ring.positions[0] = self._position()
+    
+    def run(self):
+        while not self._stop_event.is_set():
+            slot = self.ring.acquire(timeout=0.1)
+            if slot is None:
+                continue
+            
+            buffer = self.ring.frames[slot]
+            success, frame = self.cap.read(buffer)
+            if not success:
+                self.ring.release(slot)
+                break
+            
+            # Keep the returned array if the backend could not decode in place
+            if frame is not buffer:
+                self.ring.frames[slot] = frame
+            self.ring.positions[slot] = self._position()
+            self.ring.frame_numbers[slot] = self._frames_read
+            self._frames_read += 1
+            if self.preview is not None:
+                self.preview.offer(frame)
+            self.ring.publish(slot)
+        
+        self.ring.publish(None)
+    
+    def stop(self, timeout=1.0):
+        """
+        Ask the thread to finish and wait for it.
+        
+        Args:
+            timeout: Longest wait in seconds, a stalled source can block a read indefinitely
+        
+        Returns:
+            True if the thread has finished
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+        return not self.is_alive()
+    
+    def _position(self):
+        # Video files report the frame's timestamp, live sources often only 0
+        position = self.cap.get(cv2.CAP_PROP_POS_MSEC)
+        if position > 0:
+            return position
+        return (time.perf_counter() - self._first_frame_time) * 1000
+
+
+class SceneChangeGate:
+    """
+    Decide whether a frame changed enough since the last inference to classify it again.
+    
+    Frames are reduced to small grayscale thumbnails and compared by mean
+    absolute difference. The same thumbnails are used to detect a frozen
+    camera (identical consecutive frames) and blank frames (no contrast).
+    """
+    
+    def __init__(self, threshold, thumb_size=(32, 32), frozen_frames=30, blank_std=2.0):
+        self.threshold = threshold
+        self.thumb_size = thumb_size
+        self.frozen_frames = frozen_frames
+        self.blank_std = blank_std
+        
+        # Preallocated thumbnails: scaled colour, current, previous and last classified
+        width, height = thumb_size
+        self._small = np.empty((height, width, 3), dtype=np.uint8)
+        self._current = np.empty((height, width), dtype=np.uint8)
+        self._previous = np.empty((height, width), dtype=np.uint8)
+        self._reference = np.empty((height, width), dtype=np.uint8)
+        self._has_previous = False
+        self._has_reference = False
+        self._static_frames = 0
+        
+        self.score = 0.0
+        self.frozen = False
+        self.blank = False
+        self.skipped = 0
+    
+    def update(self, frame):
+        """
+        Compare a frame against the last classified one.
+        
+        Args:
+            frame: BGR frame
+        
+        Returns:
+            True if the frame should be classified, False to reuse the last result
+        """
+        cv2.resize(frame, self.thumb_size, dst=self._small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._current)
+        
+        # Blank frame: almost no contrast left in the thumbnail
+        self.blank = cv2.meanStdDev(self._current)[1][0, 0] < self.blank_std
+        
+        # Frozen camera: the exact same picture for many frames in a row
+        if self._has_previous and cv2.norm(self._current, self._previous, cv2.NORM_L1) == 0:
+            self._static_frames += 1
+        else:
+            self._static_frames = 0
+        self.frozen = self._static_frames >= self.frozen_frames
+        self._current, self._previous = self._previous, self._current
+        self._has_previous = True
+        
+        if not self._has_reference:
+            run_inference = True
+        else:
+            self.score = cv2.norm(self._previous, self._reference, cv2.NORM_L1) / self._reference.size
+            run_inference = not (self.blank or self.frozen) and self.score >= self.threshold
+        
+        if run_inference:
+            np.copyto(self._reference, self._previous)
+            self._has_reference = True
+        else:
+            self.skipped += 1
+        return run_inference
+
+
+def import_yolo():
+    """Import the ultralytics YOLO class only when a PyTorch model is needed."""
+    try:
+        from ultralytics import YOLO
+    except ImportError:
+        raise ImportError("Ultralytics is required for this backend or to export models. "
+                          "Please install it with: pip install ultralytics")
+    return YOLO
+
+
+def export_onnx(model_path, imgsz=224):
+    """
+    Export a YOLOv8 classification checkpoint to ONNX, reusing an earlier export.
+    
+    Args:
+        model_path: Path to a .pt checkpoint or an already exported .onnx file
+        imgsz: Input size used for the export
+    
+    Returns:
+        Path to the ONNX model
+    """
+    model_path = Path(model_path)
+    if model_path.suffix == ".onnx":
+        return model_path
+    
+    onnx_path = model_path.with_suffix(".onnx")
+    if not onnx_path.exists():
+        print(f"Exporting {model_path} to ONNX...")
+        # Dynamic axes allow batching and a different input size per call
+        YOLO = import_yolo()
+        onnx_path = Path(YOLO(str(model_path)).export(format="onnx", imgsz=imgsz, dynamic=True))
+    return onnx_path
+
+
+def parse_class_names(value, num_classes=0):
+    """Parse the class names stored in exported model metadata."""
+    if value:
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+    return {i: str(i) for i in range(num_classes)}
+
+
+def load_onnx_class_names(onnx_path, num_classes=0):
+    """Read class names from ONNX metadata with whichever ONNX reader is installed."""
+    try:
+        import onnxruntime as ort
+        session = ort.InferenceSession(str(onnx_path), providers=["CPUExecutionProvider"])
+        return parse_class_names(session.get_modelmeta().custom_metadata_map.get("names"), num_classes)
+    except ImportError:
+        pass
+    try:
+        import onnx
+        metadata = {prop.key: prop.value for prop in onnx.load(str(onnx_path), load_external_data=False).metadata_props}
+        return parse_class_names(metadata.get("names"), num_classes)
+    except ImportError:
+        pass
+    return parse_class_names(None, num_classes)
+
+
+def preprocess_classify(frame, imgsz=224, out=None):
+    """
+    Prepare a BGR frame the way YOLOv8 classification models expect.
+    
+    The short side is resized to imgsz and the center is cropped, then the
+    crop is converted to RGB, CHW layout and scaled to [0, 1].
+    
+    Args:
+        frame: BGR frame
+        imgsz: Model input size
+        out: Optional float32 array of shape (3, imgsz, imgsz) to write into
+    
+    Returns:
+        Preprocessed float32 array of shape (3, imgsz, imgsz)
+    """
+    if out is None:
+        out = np.empty((3, imgsz, imgsz), dtype=np.float32)
+    
+    height, width = frame.shape[:2]
+    scale = imgsz / min(height, width)
+    resized_width = max(imgsz, round(width * scale))
+    resized_height = max(imgsz, round(height * scale))
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    resized = cv2.resize(frame, (resized_width, resized_height), interpolation=interpolation)
+    
+    top = (resized_height - imgsz) // 2
+    left = (resized_width - imgsz) // 2
+    crop = resized[top:top + imgsz, left:left + imgsz, ::-1]
+    np.multiply(crop.transpose(2, 0, 1), 1 / 255, out=out)
+    return out
+
+
+class ClassificationProbs:
+    """Minimal stand-in for the ultralytics Probs object, backed by a NumPy vector."""
+    
+    def __init__(self, data):
+        self.data = data
+    
+    @property
+    def top1(self):
+        return int(self.data.argmax())
+    
+    @property
+    def top5(self):
+        return topk_classes(self.data, 5)[0].tolist()
+    
+    @property
+    def top1conf(self):
+        return self.data[self.top1]
+    
+    @property
+    def top5conf(self):
+        return self.data[self.top5]
+
+
+class ClassificationResult:
+    """Minimal stand-in for an ultralytics Results object from a non-PyTorch backend."""
+    
+    def __init__(self, probs, names):
+        self.probs = ClassificationProbs(probs)
+        self.names = names
+
+
+class OnnxRuntimeClassifier:
+    """
+    YOLOv8 classifier running on an ONNX Runtime CPU session.
+    
+    Called like a YOLO model: model(frames, verbose=False) returns one
+    result per frame with the same probs and names attributes.
+    """
+    
+    def __init__(self, onnx_path, imgsz=224, intra_op_threads=0, inter_op_threads=0):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("ONNX Runtime is required for --backend onnxruntime. "
+                              "Please install it with: pip install onnxruntime")
+        
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        self.session = ort.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+        
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.fixed_size = isinstance(model_input.shape[-1], int)
+        self.imgsz = model_input.shape[-1] if self.fixed_size else imgsz
+        
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        num_classes = self.session.get_outputs()[0].shape[-1]
+        self.names = parse_class_names(metadata.get("names"), num_classes if isinstance(num_classes, int) else 0)
+        
+        # Input batch buffers per input size, grown when a larger batch arrives
+        self._batches = {}
+    
+    def __call__(self, source, verbose=False, imgsz=None):
+        frames = source if isinstance(source, list) else [source]
+        imgsz = imgsz or self.imgsz
+        if self.fixed_size and imgsz != self.imgsz:
+            raise ValueError(f"The ONNX model was exported with a fixed input size of {self.imgsz}")
+        
+        batch = self._batches.get(imgsz)
+        if batch is None or len(frames) > len(batch):
+            batch = np.empty((len(frames), 3, imgsz, imgsz), dtype=np.float32)
+            self._batches[imgsz] = batch
+        
+        batch = batch[:len(frames)]
+        for frame, out in zip(frames, batch):
+            preprocess_classify(frame, imgsz, out)
+        
+        probs = self.session.run(None, {self.input_name: batch})[0]
+        return [ClassificationResult(p, self.names) for p in probs]
+
+
+class OpenCVDnnClassifier:
+    """
+    YOLOv8 classifier running on the OpenCV DNN module.
+    
+    Needs only the opencv-python dependency at inference time, so torch and
+    ultralytics are never imported once the ONNX model exists.
+    """
+    
+    def __init__(self, onnx_path, imgsz=224, threads=0):
+        if threads > 0:
+            cv2.setNumThreads(threads)
+        self.net = cv2.dnn.readNetFromONNX(str(onnx_path))
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.imgsz = imgsz
+        
+        # Warm up once, which also tells us the number of classes
+        self.net.setInput(np.zeros((1, 3, imgsz, imgsz), dtype=np.float32))
+        num_classes = self.net.forward().shape[-1]
+        self.names = load_onnx_class_names(onnx_path, num_classes)
+    
+    def __call__(self, source, verbose=False, imgsz=None):
+        frames = source if isinstance(source, list) else [source]
+        imgsz = imgsz or self.imgsz
+        
+        # Short-side resize, center crop, BGR to RGB and scaling to [0, 1] in one call
+        blob = cv2.dnn.blobFromImages(frames, scalefactor=1 / 255, size=(imgsz, imgsz),
+                                      swapRB=True, crop=True)
+        self.net.setInput(blob)
+        probs = self.net.forward()
+        return [ClassificationResult(p, self.names) for p in probs]
+
+
+class OpenVINOClassifier:
+    """
+    YOLOv8 classifier compiled with OpenVINO for the CPU.
+    
+    Every frame of a call is started on its own asynchronous infer request,
+    so a batch keeps several inferences in flight across the CPU cores.
+    """
+    
+    def __init__(self, onnx_path, imgsz=224, hint="LATENCY", num_requests=0, threads=0):
+        try:
+            import openvino as ov
+        except ImportError:
+            raise ImportError("OpenVINO is required for --backend openvino. "
+                              "Please install it with: pip install openvino")
+        
+        self._ov = ov
+        self._core = ov.Core()
+        self._model = self._core.read_model(str(onnx_path))
+        self._config = {"PERFORMANCE_HINT": hint}
+        if threads > 0:
+            self._config["INFERENCE_NUM_THREADS"] = threads
+        self._num_requests = num_requests
+        
+        # One compiled model, request queue and input buffer per input size
+        self._infer_queues = {}
+        self._inputs = {}
+        
+        self.imgsz = imgsz
+        infer_queue = self._infer_queue(imgsz)
+        num_classes = self._model.output(0).get_partial_shape()[-1].get_length()
+        self.names = load_onnx_class_names(onnx_path, num_classes)
+        self.num_requests = len(infer_queue)
+    
+    def _infer_queue(self, imgsz):
+        infer_queue = self._infer_queues.get(imgsz)
+        if infer_queue is None:
+            # One image per request, parallelism comes from running requests concurrently
+            model = self._model.clone()
+            model.reshape([1, 3, imgsz, imgsz])
+            compiled_model = self._core.compile_model(model, "CPU", self._config)
+            
+            num_requests = self._num_requests
+            if num_requests <= 0:
+                num_requests = compiled_model.get_property("OPTIMAL_NUMBER_OF_INFER_REQUESTS")
+            infer_queue = self._ov.AsyncInferQueue(compiled_model, num_requests)
+            infer_queue.set_callback(self._on_done)
+            
+            # Input data is copied into the request when it starts, so one buffer is enough
+            self._infer_queues[imgsz] = infer_queue
+            self._inputs[imgsz] = np.empty((1, 3, imgsz, imgsz), dtype=np.float32)
+        return infer_queue
+    
+    @staticmethod
+    def _on_done(request, userdata):
+        probs, index = userdata
+        probs[index] = request.get_output_tensor(0).data[0].copy()
+    
+    def __call__(self, source, verbose=False, imgsz=None):
+        frames = source if isinstance(source, list) else [source]
+        imgsz = imgsz or self.imgsz
+        infer_queue = self._infer_queue(imgsz)
+        model_input = self._inputs[imgsz]
+        probs = [None] * len(frames)
+        
+        # start_async only blocks when every infer request is busy
+        for index, frame in enumerate(frames):
+            preprocess_classify(frame, imgsz, model_input[0])
+            infer_queue.start_async({0: model_input}, (probs, index))
+        infer_queue.wait_all()
+        
+        return [ClassificationResult(p, self.names) for p in probs]
+
+
+class CascadeClassifier:
+    """
+    Two-tier model cascade driven by a confidence threshold.
+    
+    Every frame runs through the small model. Frames whose top-1 probability
+    is below the threshold are classified again by the large model, and its
+    result replaces the small model's one. Both models stay loaded.
+    """
+    
+    def __init__(self, small_model, large_model, threshold):
+        self.small_model = small_model
+        self.large_model = large_model
+        self.threshold = threshold
+        
+        # Statistics for each tier
+        self.frame_count = 0
+        self.escalated_count = 0
+        self.small_time = 0.0
+        self.large_time = 0.0
+    
+    def __call__(self, source, verbose=False, **kwargs):
+        frames = source if isinstance(source, list) else [source]
+        
+        start = time.perf_counter()
+        results = list(self.small_model(frames, verbose=verbose, **kwargs))
+        self.small_time += time.perf_counter() - start
+        self.frame_count += len(frames)
+        
+        # Escalate only the uncertain frames, still in one batch
+        uncertain = [i for i, result in enumerate(results)
+                     if result.probs is not None and float(result.probs.top1conf) < self.threshold]
+        if uncertain:
+            start = time.perf_counter()
+            escalated = self.large_model([frames[i] for i in uncertain], verbose=verbose, **kwargs)
+            self.large_time += time.perf_counter() - start
+            self.escalated_count += len(uncertain)
+            
+            for i, result in zip(uncertain, escalated):
+                results[i] = result
+        
+        return results
+    
+    def print_stats(self):
+        """Print the escalation rate and the cost of each tier."""
+        if self.frame_count == 0:
+            return
+        print(f"Cascade escalation rate: {self.escalated_count / self.frame_count:.1%} "
+              f"({self.escalated_count}/{self.frame_count} frames)")
+        print(f"Small model: {self.small_time:.2f} s total, "
+              f"{1000 * self.small_time / self.frame_count:.1f} ms/frame")
+        if self.escalated_count:
+            print(f"Large model: {self.large_time:.2f} s total, "
+                  f"{1000 * self.large_time / self.escalated_count:.1f} ms/escalated frame")
+
+
+class ResolutionCascade:
+    """
+    Classify at a reduced input size first and re-run uncertain frames at full size.
+    
+    A frame is uncertain when the margin between its two best classes is below
+    the threshold, or when its entropy (normalized to [0, 1]) is above it.
+    Each decoded frame is shrunk once to the full input size, and both passes
+    are preprocessed from that copy.
+    """
+    
+    def __init__(self, model, low_imgsz=128, full_imgsz=224, metric="margin", threshold=0.2):
+        self.model = model
+        self.low_imgsz = low_imgsz
+        self.full_imgsz = full_imgsz
+        self.metric = metric
+        self.threshold = threshold
+        
+        # Statistics for both passes
+        self.frame_count = 0
+        self.rerun_count = 0
+        self.low_res_time = 0.0
+        self.full_res_time = 0.0
+    
+    def _shrink(self, frame):
+        scale = self.full_imgsz / min(frame.shape[:2])
+        if scale >= 1:
+            return frame
+        size = (round(frame.shape[1] * scale), round(frame.shape[0] * scale))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    
+    def _is_uncertain(self, probs):
+        if probs is None:
+            return False
+        data = probs.data
+        if not isinstance(data, np.ndarray):
+            data = data.cpu().numpy()
+        
+        if self.metric == "entropy":
+            entropy = -np.sum(data * np.log(np.clip(data, 1e-12, None)))
+            return entropy / np.log(len(data)) > self.threshold
+        
+        top2 = np.partition(data, -2)[-2:]
+        return top2[1] - top2[0] < self.threshold
+    
+    def __call__(self, source, verbose=False, **kwargs):
+        frames = source if isinstance(source, list) else [source]
+        shrunk = [self._shrink(frame) for frame in frames]
+        
+        start = time.perf_counter()
+        results = list(self.model(shrunk, verbose=verbose, imgsz=self.low_imgsz, **kwargs))
+        self.low_res_time += time.perf_counter() - start
+        self.frame_count += len(frames)
+        
+        # Re-run only the uncertain frames, still in one batch
+        uncertain = [i for i, result in enumerate(results) if self._is_uncertain(result.probs)]
+        if uncertain:
+            start = time.perf_counter()
+            rerun = self.model([shrunk[i] for i in uncertain], verbose=verbose, imgsz=self.full_imgsz, **kwargs)
+            self.full_res_time += time.perf_counter() - start
+            self.rerun_count += len(uncertain)
+            
+            for i, result in zip(uncertain, rerun):
+                results[i] = result
+        
+        return results
+    
+    def print_stats(self):
+        """Print how many frames needed the full-resolution pass and the cost of both passes."""
+        if self.frame_count == 0:
+            return
+        print(f"Full-resolution re-run rate: {self.rerun_count / self.frame_count:.1%} "
+              f"({self.rerun_count}/{self.frame_count} frames)")
+        print(f"Low-resolution pass ({self.low_imgsz}): {self.low_res_time:.2f} s total, "
+              f"{1000 * self.low_res_time / self.frame_count:.1f} ms/frame")
+        if self.rerun_count:
+            print(f"Full-resolution pass ({self.full_imgsz}): {self.full_res_time:.2f} s total, "
+                  f"{1000 * self.full_res_time / self.rerun_count:.1f} ms/re-run frame")
+
+
+def load_model(args, model_path=None):
+    """Load the classifier for the selected backend."""
+    model_path = model_path or args.model
+    if args.backend == "onnxruntime":
+        onnx_path = export_onnx(model_path, args.imgsz)
+        return OnnxRuntimeClassifier(onnx_path, args.imgsz, args.threads, args.inter_op_threads)
+    if args.backend == "opencv":
+        onnx_path = export_onnx(model_path, args.imgsz)
+        return OpenCVDnnClassifier(onnx_path, args.imgsz, args.threads)
+    if args.backend == "openvino":
+        onnx_path = export_onnx(model_path, args.imgsz)
+        hint = args.ov_hint
+        if hint == "auto":
+            # Webcams want low latency, offline video files want throughput
+            hint = "latency" if any(device.isdigit() for device in args.device) else "throughput"
+        return OpenVINOClassifier(onnx_path, args.imgsz, hint.upper(), args.ov_requests, args.threads)
+    
+    YOLO = import_yolo()
+    return YOLO(model_path)
+
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp']
+
+
+def read_images(paths):
+    """
+    Decode images one at a time, skipping files OpenCV cannot read.
+    
+    Args:
+        paths: Image file paths
+    
+    Yields:
+        BGR images
+    """
+    for path in paths:
+        image = cv2.imread(str(path))
+        if image is not None:
+            yield image
+
+
+def measure_agreement(reference, candidate, images, batch_size=8):
+    """
+    Compare two classifiers on a stream of images.
+    
+    Args:
+        reference: Classifier whose predictions are treated as ground truth
+        candidate: Classifier under test
+        images: Iterable of BGR images, only one batch is held in memory at a time
+        batch_size: Images per model call
+    
+    Returns:
+        Tuple of (top-1 agreement, top-5 agreement, reference images/s, candidate images/s)
+    """
+    top1_matches = 0
+    top5_matches = 0
+    image_count = 0
+    reference_time = 0.0
+    candidate_time = 0.0
+    
+    images = iter(images)
+    while True:
+        batch = [image for _, image in zip(range(batch_size), images)]
+        if not batch:
+            break
+        image_count += len(batch)
+        
+        start = time.perf_counter()
+        reference_results = reference(batch)
+        reference_time += time.perf_counter() - start
+        
+        start = time.perf_counter()
+        candidate_results = candidate(batch)
+        candidate_time += time.perf_counter() - start
+        
+        for expected, actual in zip(reference_results, candidate_results):
+            top1_matches += expected.probs.top1 == actual.probs.top1
+            top5_matches += expected.probs.top1 in actual.probs.top5
+    
+    if image_count == 0:
+        raise ValueError("No readable images to compare the models on")
+    
+    return (top1_matches / image_count, top5_matches / image_count,
+            image_count / reference_time, image_count / candidate_time)
+
+
+def quantize_int8(args):
+    """
+    Post-training INT8 quantization of the exported ONNX model with ONNX Runtime.
+    
+    Calibrates on images from a dataset/val/<class>/ folder, reports top-1 and
+    top-5 agreement with the FP32 model plus throughput of both, and keeps the
+    quantized model only if top-1 agreement reaches --min-agreement.
+    
+    Args:
+        args: Parsed command line arguments
+    
+    Returns:
+        Path to the accepted INT8 model, or None if it was rejected
+    """
+    try:
+        from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    except ImportError:
+        raise ImportError("ONNX Runtime is required for --quantize. "
+                          "Please install it with: pip install onnxruntime")
+    
+    image_paths = sorted(path for path in Path(args.calib_data).glob("*/*")
+                         if path.suffix.lower() in IMAGE_EXTENSIONS)
+    if not image_paths:
+        print(f"Error: No images found in {args.calib_data}/<class>/")
+        return None
+    
+    fp32_path = export_onnx(args.model, args.imgsz)
+    int8_path = fp32_path.with_name(f"{fp32_path.stem}-int8.onnx")
+    candidate_path = fp32_path.with_name(f"{fp32_path.stem}-int8.candidate.onnx")
+    
+    # Spread the calibration images over all classes, decoding them only when needed
+    step = max(1, len(image_paths) // args.calib_images)
+    calibration_paths = image_paths[::step][:args.calib_images]
+    calibration_images = read_images(calibration_paths)
+    first_image = next(calibration_images, None)
+    if first_image is None:
+        print(f"Error: None of the calibration images in {args.calib_data}/<class>/ could be read")
+        return None
+    
+    class FrameCalibrationReader(CalibrationDataReader):
+        def __init__(self, input_name):
+            self.input_name = input_name
+            self.next_image = first_image
+        
+        def get_next(self):
+            image = self.next_image
+            if image is None:
+                return None
+            self.next_image = next(calibration_images, None)
+            return {self.input_name: preprocess_classify(image, args.imgsz)[None]}
+    
+    fp32_model = OnnxRuntimeClassifier(fp32_path, args.imgsz, args.threads, args.inter_op_threads)
+    print(f"Calibrating INT8 model on {len(calibration_paths)} images...")
+    quantize_static(
+        str(fp32_path), 
+        str(candidate_path), 
+        FrameCalibrationReader(fp32_model.input_name), 
+        quant_format=QuantFormat.QDQ, 
+        activation_type=QuantType.QInt8, 
+        weight_type=QuantType.QInt8, 
+        per_channel=True
+    )
+    
+    int8_model = OnnxRuntimeClassifier(candidate_path, args.imgsz, args.threads, args.inter_op_threads)
+    print(f"Checking INT8 model against FP32 on {len(image_paths)} images...")
+    top1, top5, fp32_speed, int8_speed = measure_agreement(fp32_model, int8_model, read_images(image_paths),
+                                                           args.max_batch)
+    
+    print(f"Top-1 agreement: {top1:.2%}")
+    print(f"Top-5 agreement: {top5:.2%}")
+    print(f"FP32 throughput: {fp32_speed:.1f} images/s")
+    print(f"INT8 throughput: {int8_speed:.1f} images/s ({int8_speed / fp32_speed:.2f}x)")
+    
+    if top1 < args.min_agreement:
+        candidate_path.unlink()
+        print(f"Rejected: top-1 agreement is below {args.min_agreement:.2%}")
+        return None
+    
+    candidate_path.replace(int8_path)
+    print(f"Accepted: saved INT8 model to {int8_path}")
+    return int8_path
+
+
+BatchStats = collections.namedtuple("BatchStats", ["size", "queue_wait", "inference_time"])
+
+
+class MicroBatcher:
+    """
+    Collect frames from any number of producers and classify them in batches.
+    
+    A batch is dispatched as soon as it holds max_batch_size frames, when its
+    oldest frame has waited max_wait seconds, or when flush() is called.
+    submit() returns a Future that resolves to the frame's result.
+    """
+    
+    _FLUSH = object()
+    _STOP = object()
+    
+    def __init__(self, model, max_batch_size=8, max_wait=0.005, history=1024, **predict_kwargs):
+        self.model = model
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_wait = max_wait
+        self.predict_kwargs = predict_kwargs
+        
+        # Recent batches plus running totals for the whole run
+        self.history = collections.deque(maxlen=history)
+        self.batch_count = 0
+        self.frame_count = 0
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+        
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def submit(self, frame):
+        """Queue a frame for classification and return a Future for its result."""
+        future = Future()
+        self._queue.put((frame, future, time.perf_counter()))
+        return future
+    
+    def flush(self):
+        """Dispatch whatever is queued now instead of waiting for the deadline."""
+        self._queue.put(self._FLUSH)
+    
+    def close(self):
+        """Dispatch the remaining frames and stop the worker thread."""
+        self._queue.put(self._STOP)
+        self._thread.join()
+    
+    def _run(self):
+        batch = []
+        while True:
+            # Wait for more frames only until the oldest queued frame is due
+            timeout = None
+            if batch:
+                timeout = max(batch[0][2] + self.max_wait - time.perf_counter(), 0.0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = self._FLUSH
+            
+            if item is self._STOP:
+                if batch:
+                    self._dispatch(batch)
+                break
+            if item is self._FLUSH:
+                if batch:
+                    self._dispatch(batch)
+                    batch = []
+                continue
+            
+            batch.append(item)
+            if len(batch) >= self.max_batch_size:
+                self._dispatch(batch)
+                batch = []
+    
+    def _dispatch(self, batch):
+        start = time.perf_counter()
+        queue_wait = start - batch[0][2]
+        try:
+            results = self.model([frame for frame, _, _ in batch], verbose=False, **self.predict_kwargs)
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+        
+        # Record what this batch achieved
+        self.history.append(BatchStats(len(batch), queue_wait, time.perf_counter() - start))
+        self.batch_count += 1
+        self.frame_count += len(batch)
+        self.total_queue_wait += queue_wait
+        self.max_queue_wait = max(self.max_queue_wait, queue_wait)
+    
+    def print_stats(self):
+        """Print batch size and queue-wait statistics."""
+        if self.batch_count == 0:
+            return
+        print(f"Batches: {self.batch_count}, "
+              f"mean size: {self.frame_count / self.batch_count:.2f}, "
+              f"mean queue wait: {1000 * self.total_queue_wait / self.batch_count:.1f} ms, "
+              f"max queue wait: {1000 * self.max_queue_wait:.1f} ms")
+
+
+def custom_visualization(frame, results, top_k=3, top=None, out=None):
     """
     Custom visualization of classification results.
     
@@ -44,39 +1097,37 @@ def custom_visualization(frame, results, top_k=3):
         frame: Original frame
         results: YOLOv8 results
         top_k: Number of top predictions to display
+        top: Optional (class indices, probabilities) to show instead of the raw top-k
+        out: Optional preallocated buffer of the frame's shape to draw into
     
     Returns:
         Annotated frame with custom visualization
     """
-    # Create a copy of the original frame
-    annotated_frame = frame.copy()
+    # Copy the original frame, into the caller's buffer if one is given
+    if out is None:
+        annotated_frame = frame.copy()
+    else:
+        annotated_frame = out
+        np.copyto(annotated_frame, frame)
     
     # Get the probs from the first result
     probs = results[0].probs
     
     if probs is not None:
-        # Get the top k class indices and their probabilities
-        top_indices = probs.top5[:top_k]
-        top_probs = probs.top5conf[:top_k]
+        # Get the top k class indices and their probabilities in one pass
+        if top is None:
+            top = topk_classes(probs.data, top_k)
+        top_indices, top_probs = top[0][:top_k], top[1][:top_k]
         
         # Get class names
         class_names = results[0].names
         
-        # Create a semi-transparent overlay for the prediction area
-        overlay = annotated_frame.copy()
-        cv2.rectangle(overlay, (0, 0), (300, 30 + 30 * top_k), (0, 0, 0), -1)
-        cv2.addWeighted(overlay, 0.5, annotated_frame, 0.5, 0, annotated_frame)
+        # Darken the prediction area in place, blending only that region
+        roi = annotated_frame[:31 + 30 * top_k, :301]
+        cv2.addWeighted(roi, 0.5, roi, 0, 0, roi)
         
         # Add title
-        cv2.putText(
-            annotated_frame, 
-            "Top Predictions:", 
-            (10, 25), 
-            cv2.FONT_HERSHEY_SIMPLEX, 
-            0.7, 
-            (255, 255, 255), 
-            2
-        )
+        text_sprites.draw(annotated_frame, "Top Predictions:", (10, 25), 0.7, (255, 255, 255), 2)
         
         # Add each prediction
         for i in range(len(top_indices)):
@@ -92,17 +1143,9 @@ def custom_visualization(frame, results, top_k=3):
             else:
                 color = (0, 0, 255)  # Red
             
-            # Add text
-            text = f"{i+1}. {class_name}: {prob:.2f}"
-            cv2.putText(
-                annotated_frame, 
-                text, 
-                (10, 55 + i * 30), 
-                cv2.FONT_HERSHEY_SIMPLEX, 
-                0.6, 
-                color, 
-                2
-            )
+            # Add text, with the probability drawn from the digit atlas
+            x = text_sprites.draw(annotated_frame, f"{i+1}. {class_name}: ", (10, 55 + i * 30), 0.6, color, 2)
+            text_sprites.draw_number(annotated_frame, f"{prob:.2f}", (x, 55 + i * 30), 0.6, color, 2)
             
             # Add confidence bar
             bar_length = int(200 * prob)
@@ -117,162 +1160,1026 @@ def custom_visualization(frame, results, top_k=3):
     return annotated_frame
 
 
-def main():
-    """Main function for real-time classification."""
-    # Parse arguments
-    args = parse_arguments()
+def basic_visualization(frame, results, top_k=3, top=None, out=None):
+    """
+    Plain text visualization of classification results.
     
-    # Load the model
-    print(f"Loading model: {args.model}...")
-    model = YOLO(args.model)
+    Args:
+        frame: Original frame
+        results: YOLOv8 results
+        top_k: Number of top predictions to display
+        top: Optional (class indices, probabilities) to show instead of the raw top-k
+        out: Optional preallocated buffer of the frame's shape to draw into
     
-    # Open webcam or video file
-    try:
-        device = int(args.device)  # Try to convert to integer for webcam index
-    except ValueError:
-        device = args.device  # Use as string path for video file
+    Returns:
+        Annotated frame with the top predictions as text
+    """
+    # For classification, we need to create our own visualization
+    if out is None:
+        annotated_frame = frame.copy()
+    else:
+        annotated_frame = out
+        np.copyto(annotated_frame, frame)
     
-    print(f"Opening video source: {device}...")
-    cap = cv2.VideoCapture(device)
+    # Get the probs from the first result
+    probs = results[0].probs
     
-    if not cap.isOpened():
-        print(f"Error: Could not open video source {device}")
-        return
+    if probs is not None:
+        # Get the top k class indices and their probabilities in one pass
+        if top is None:
+            top = topk_classes(probs.data, top_k)
+        top_indices, top_probs = top[0][:top_k], top[1][:top_k]
+        
+        # Get class names
+        class_names = results[0].names
+        
+        # Add each prediction
+        y_offset = 30
+        for i in range(len(top_indices)):
+            class_idx = top_indices[i]
+            prob = top_probs[i].item()
+            class_name = class_names[class_idx]
+            
+            x = text_sprites.draw(annotated_frame, f"{class_name}: ", (10, y_offset), 0.7, (0, 255, 0), 2)
+            text_sprites.draw_number(annotated_frame, f"{prob:.2f}", (x, y_offset), 0.7, (0, 255, 0), 2)
+            y_offset += 30
+    
+    return annotated_frame
+
+
+def open_video_writer(path, width, height, fps, args):
+    """
+    Create the video writer selected by --writer.
+    
+    Args:
+        path: Output file
+        width: Frame width
+        height: Frame height
+        fps: Source frame rate, 0 if unknown
+        args: Parsed command line arguments
+    
+    Returns:
+        Object with the cv2.VideoWriter write() and release() methods
+    """
+    # Webcams often report no frame rate
+    fps = fps if fps > 0 else 30.0
     
-    # Get video properties
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = cap.get(cv2.CAP_PROP_FPS)
+    if args.writer == "ffmpeg":
+        output_size = tuple(int(value) for value in args.ffmpeg_size.lower().split("x")) if args.ffmpeg_size else None
+        return FFmpegWriter(path, width, height, fps, args.ffmpeg_codec, args.ffmpeg_preset, args.ffmpeg_crf,
+                            args.ffmpeg_threads, output_size, args.ffmpeg_fps)
     
-    # Create output video writer if saving is enabled
-    output_writer = None
-    if args.save:
-        output_path = f"output_{Path(args.model).stem}_{time.strftime('%Y%m%d_%H%M%S')}.mp4"
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        output_writer = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
-        print(f"Saving output to: {output_path}")
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    return cv2.VideoWriter(str(path), fourcc, fps, (width, height))
+
+
+class SegmentedVideoWriter:
+    """
+    Splits a recording into numbered files of fixed duration or size.
     
-    # Variables for FPS calculation
-    frame_count = 0
-    start_time = time.time()
-    fps_display = 0
+    A crash only loses the segment being written, and long sessions end up as
+    files of manageable size. The next segment's writer is opened in the
+    background while the current one fills, and finished segments are
+    released there too, so a rollover is just a swap.
+    """
     
-    # Variables for prediction smoothing
-    smoothed_probs = None
-    alpha = 0.7  # Smoothing factor (higher = more smoothing)
+    def __init__(self, path, open_writer, fps, segment_seconds=0, segment_bytes=0):
+        self.path = Path(path)
+        self.open_writer = open_writer  # Called with a segment path, returns a writer
+        self.segment_frames = int(round(segment_seconds * fps)) if segment_seconds > 0 else 0
+        self.segment_bytes = segment_bytes
+        self.segments = 1
+        self._index = 0
+        self._frames = 0
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._current_path = self._segment_path()
+        self._current = open_writer(self._current_path)
+        self._open_next()
     
-    print("Starting classification. Press 'q' to quit.")
+    def write(self, frame):
+        """Write a frame, starting the next segment first if the current one is full."""
+        if self._segment_full():
+            self._rollover()
+        self._current.write(frame)
+        self._frames += 1
     
-    # Main loop
-    while cap.isOpened():
-        # Read a frame
-        success, frame = cap.read()
+    def release(self):
+        """Finish the last segment and discard the one opened ahead."""
+        if self._current is None:
+            return
+        self._executor.submit(self._current.release)
+        self._current = None
         
-        if not success:
-            print("Error: Failed to read frame")
-            break
+        path, future = self._next
+        future.result().release()
+        self._executor.shutdown(wait=True)
+        path.unlink(missing_ok=True)
+    
+    def _segment_path(self):
+        path = self.path.with_name(f"{self.path.stem}_{self._index:04d}{self.path.suffix}")
+        self._index += 1
+        return path
+    
+    def _open_next(self):
+        path = self._segment_path()
+        self._next = (path, self._executor.submit(self.open_writer, path))
+    
+    def _segment_full(self):
+        if self._frames == 0:
+            return False
+        if self.segment_frames and self._frames >= self.segment_frames:
+            return True
+        if self.segment_bytes > 0:
+            try:
+                return os.path.getsize(self._current_path) >= self.segment_bytes
+            except OSError:
+                return False
+        return False
+    
+    def _rollover(self):
+        # Finalize the full segment in the background and switch to the one opened ahead
+        self._executor.submit(self._current.release)
+        self._current_path, future = self._next
+        self._current = future.result()
+        self._frames = 0
+        self.segments += 1
+        self._open_next()
+
+
+class ClipRecorder:
+    """
+    Records short clips around moments when a watched class is detected.
+    
+    Until something happens, frames only go into a fixed-size ring of JPEG
+    encoded frames covering the pre-roll, a fraction of their raw size. A
+    trigger opens a new clip, writes the pre-roll from the ring and then every
+    frame until post_roll seconds have passed without another trigger.
+    Finished clips are released on a background worker.
+    
+    Triggers are raised with trigger() and held until the next frame is
+    written, so a queue that drops frames under load never loses an event.
+    """
+    
+    def __init__(self, path, open_writer, fps, pre_roll=5.0, post_roll=5.0, jpeg_quality=90):
+        self.path = Path(path)
+        self.open_writer = open_writer  # Called with a clip path, returns a writer
+        self.post_roll_frames = max(1, int(round(post_roll * fps)))
+        self.jpeg_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        self.clips = 0
+        self._pre_roll = collections.deque(maxlen=max(1, int(round(pre_roll * fps))))
+        self._writer = None
+        self._frames_left = 0
+        self._pending_trigger = False
+        self._trigger_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+    
+    def trigger(self):
+        """Start or extend a clip from the next written frame on. Safe to call from any thread."""
+        with self._trigger_lock:
+            self._pending_trigger = True
+    
+    def write(self, frame):
+        """
+        Add a frame to the pre-roll or to the clip being recorded.
         
-        # Update FPS calculation
-        frame_count += 1
-        elapsed_time = time.time() - start_time
-        if elapsed_time >= 1.0:  # Update FPS every second
-            fps_display = frame_count / elapsed_time
-            frame_count = 0
-            start_time = time.time()
-        
-        # Run YOLOv8 inference
-        results = model(
-            frame, 
-            verbose=False
-        )
-        
-        # Apply temporal smoothing to predictions
-        if results[0].probs is not None:
-            current_probs = results[0].probs.data.cpu().numpy()
+        Args:
+            frame: Annotated frame
+        """
+        with self._trigger_lock:
+            triggered, self._pending_trigger = self._pending_trigger, False
+        if triggered:
+            if self._writer is None:
+                self._start_clip()
+            self._frames_left = self.post_roll_frames + 1
+        
+        if self._writer is None:
+            success, encoded = cv2.imencode(".jpg", frame, self.jpeg_params)
+            if success:
+                self._pre_roll.append(encoded)
+            return
+        
+        self._writer.write(frame)
+        self._frames_left -= 1
+        if self._frames_left == 0:
+            self._executor.submit(self._writer.release)
+            self._writer = None
+    
+    def release(self):
+        """Finish the clip being recorded, if any."""
+        if self._writer is not None:
+            self._executor.submit(self._writer.release)
+            self._writer = None
+        self._executor.shutdown(wait=True)
+    
+    def _start_clip(self):
+        path = self.path.with_name(f"{self.path.stem}_clip{self.clips:04d}{self.path.suffix}")
+        self.clips += 1
+        print(f"Recording clip: {path}")
+        self._writer = self.open_writer(path)
+        
+        # The clip starts with the frames that led up to the trigger
+        for encoded in self._pre_roll:
+            self._writer.write(cv2.imdecode(encoded, cv2.IMREAD_COLOR))
+        self._pre_roll.clear()
+
+
+class SubtitleWriter:
+    """
+    Writes the predictions as a WebVTT or SRT subtitle track.
+    
+    Consecutive frames with the same text are merged into one cue, which is
+    written once the text changes, so the file grows with the number of
+    prediction changes rather than frames. Players show the track over the
+    original video, so nothing is decoded or re-encoded for output.
+    """
+    
+    def __init__(self, path, subtitle_format="vtt", frame_duration=1 / 30):
+        self.path = Path(path)
+        self.subtitle_format = subtitle_format
+        self.frame_duration = frame_duration  # How long the last cue stays on screen
+        self.cues = 0
+        self._text = None
+        self._start = 0.0
+        self._last = 0.0
+        self._origin = None
+        self._file = open(self.path, "w", encoding="utf-8")
+        if subtitle_format == "vtt":
+            self._file.write("WEBVTT\n\n")
+    
+    def add(self, timestamp, text):
+        """
+        Add the text shown from this frame on.
+        
+        Args:
+            timestamp: Frame time in seconds, the first frame becomes time zero
+            text: Subtitle text, empty for none
+        """
+        if self._origin is None:
+            self._origin = timestamp
+        timestamp -= self._origin
+        
+        if text != self._text:
+            self._write_cue(timestamp)
+            self._text = text
+            self._start = timestamp
+        self._last = timestamp
+    
+    def release(self):
+        """Write the last cue and close the file."""
+        if self._file.closed:
+            return
+        self._write_cue(self._last + self.frame_duration)
+        self._file.close()
+    
+    def _write_cue(self, end):
+        if not self._text:
+            return
+        self.cues += 1
+        if self.subtitle_format == "srt":
+            self._file.write(f"{self.cues}\n")
+        self._file.write(f"{self._format_time(self._start)} --> {self._format_time(end)}\n{self._text}\n\n")
+    
+    def _format_time(self, seconds):
+        milliseconds = int(round(seconds * 1000))
+        hours, milliseconds = divmod(milliseconds, 3600000)
+        minutes, milliseconds = divmod(milliseconds, 60000)
+        seconds, milliseconds = divmod(milliseconds, 1000)
+        separator = "," if self.subtitle_format == "srt" else "."
+        return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
+
+
+def mux_subtitles(video_path, subtitle_path, output_path):
+    """
+    Copy a video's video and audio streams and a subtitle track into one file without re-encoding.
+    
+    Data and timecode streams are left out, Matroska cannot hold most of them.
+    
+    Args:
+        video_path: Source video file
+        subtitle_path: WebVTT or SRT file
+        output_path: Output file, typically .mkv
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise RuntimeError("ffmpeg is required for --mux-subtitles. "
+                           "Please install it, e.g. with: apt install ffmpeg")
+    
+    command = [ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+               "-i", str(video_path), "-i", str(subtitle_path),
+               "-map", "0:v", "-map", "0:a?", "-map", "1", "-c", "copy", str(output_path)]
+    returncode = subprocess.run(command, start_new_session=True).returncode
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {returncode}")
+
+
+class PredictionSink:
+    """
+    Stores every frame's predictions in a Parquet file for offline analysis.
+    
+    Records go into preallocated column arrays. Once a row group is full the
+    arrays are handed to a background thread, which wraps them in an Arrow
+    record batch and writes it as one Parquet row group, while recording
+    continues into a second set of arrays. After a write error the sink
+    stops recording instead of blocking the caller.
+    """
+    
+    def __init__(self, path, top_k, sources, row_group_size=65536):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("PyArrow is required for --predictions. "
+                              "Please install it with: pip install pyarrow")
+        
+        self.pa = pa
+        self.path = Path(path)
+        self.top_k = top_k
+        self.row_group_size = max(1, row_group_size)
+        self.rows = 0
+        self.error = None
+        self.schema = pa.schema([
+            ("stream", pa.int16()),
+            ("frame", pa.int64()),
+            ("timestamp", pa.timestamp("us", tz="UTC")),
+            ("position", pa.float64()),
+            ("top_ids", pa.list_(pa.int32(), top_k)),
+            ("top_probs", pa.list_(pa.float32(), top_k)),
+            ("latency_ms", pa.float32()),
+        ], metadata={"sources": repr(sources)})
+        self._writer = pq.ParquetWriter(str(self.path), self.schema)
+        
+        # Two sets of columns: one being filled, one being written
+        self._free = queue.Queue()
+        for _ in range(2):
+            self._free.put(self._allocate())
+        self._full = queue.Queue()
+        self._columns = self._free.get()
+        self._count = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def add(self, stream, frame, position, top_ids, top_probs, latency_ms):
+        """
+        Record one frame's prediction.
+        
+        Args:
+            stream: Stream index
+            frame: Frame number in the source
+            position: Frame time in the source in seconds
+            top_ids: Top-k class indices, highest first
+            top_probs: Their probabilities
+            latency_ms: Time from submitting the frame to its result, NaN if the last prediction was reused
+        """
+        if self.error is not None:
+            return
+        
+        row = self._count
+        columns = self._columns
+        columns["stream"][row] = stream
+        columns["frame"][row] = frame
+        columns["timestamp"][row] = time.time_ns() // 1000
+        columns["position"][row] = position
+        
+        # Fewer classes than top_k leave the remaining entries at -1 and NaN
+        k = min(len(top_ids), self.top_k)
+        columns["top_ids"][row, :k] = top_ids[:k]
+        columns["top_ids"][row, k:] = -1
+        columns["top_probs"][row, :k] = top_probs[:k]
+        columns["top_probs"][row, k:] = np.nan
+        columns["latency_ms"][row] = latency_ms
+        
+        self._count += 1
+        if self._count == self.row_group_size:
+            self._flush()
+    
+    def close(self):
+        """Write the remaining rows and close the file."""
+        if self._thread is None:
+            return
+        if self._count > 0 and self.error is None:
+            self._flush()
+        self._full.put(None)
+        self._thread.join()
+        self._thread = None
+        try:
+            self._writer.close()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+                print(f"Error: prediction sink failed: {e}")
+    
+    def print_stats(self):
+        """Print how many rows were stored."""
+        print(f"Predictions: {self.rows} rows written to {self.path}")
+        if self.error is not None:
+            print(f"Predictions: recording stopped after an error: {self.error}")
+    
+    def _allocate(self):
+        size = self.row_group_size
+        return {
+            "stream": np.empty(size, np.int16),
+            "frame": np.empty(size, np.int64),
+            "timestamp": np.empty(size, np.int64),
+            "position": np.empty(size, np.float64),
+            "top_ids": np.empty((size, self.top_k), np.int32),
+            "top_probs": np.empty((size, self.top_k), np.float32),
+            "latency_ms": np.empty(size, np.float32),
+        }
+    
+    def _flush(self):
+        self._full.put((self._columns, self._count))
+        self._columns = self._free.get()
+        self._count = 0
+    
+    def _run(self):
+        pa = self.pa
+        while True:
+            item = self._full.get()
+            if item is None:
+                break
             
-            if smoothed_probs is None:
-                smoothed_probs = current_probs
+            # After a write failure keep recycling the columns, so _flush() never blocks forever
+            columns, count = item
+            if self.error is None:
+                try:
+                    # Arrow wraps the NumPy columns without copying them
+                    arrays = [
+                        pa.array(columns["stream"][:count]),
+                        pa.array(columns["frame"][:count]),
+                        pa.array(columns["timestamp"][:count], type=self.schema.field("timestamp").type),
+                        pa.array(columns["position"][:count]),
+                        pa.FixedSizeListArray.from_arrays(pa.array(columns["top_ids"][:count].ravel()), self.top_k),
+                        pa.FixedSizeListArray.from_arrays(pa.array(columns["top_probs"][:count].ravel()),
+                                                          self.top_k),
+                        pa.array(columns["latency_ms"][:count]),
+                    ]
+                    batch = pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+                    self._writer.write_batch(batch, row_group_size=self.row_group_size)
+                except Exception as e:
+                    self.error = e
+                    print(f"Error: prediction sink failed: {e}")
+                else:
+                    self.rows += count
+            self._free.put(columns)
+
+
+def format_predictions(results, top=None, top_k=3):
+    """
+    Format the top predictions as text lines.
+    
+    Args:
+        results: YOLOv8 results
+        top: Optional (class indices, probabilities) to use instead of the raw top-k
+        top_k: Number of predictions
+    
+    Returns:
+        One "class: probability" line per prediction, empty without a prediction
+    """
+    if results is None or results[0].probs is None:
+        return ""
+    if top is None:
+        top = topk_classes(results[0].probs.data, top_k)
+    class_names = results[0].names
+    return "\n".join(f"{class_names[int(index)]}: {float(prob):.2f}"
+                     for index, prob in zip(top[0][:top_k], top[1][:top_k]))
+
+
+def resolve_class_ids(classes, names):
+    """
+    Map class names or indices given on the command line to class indices.
+    
+    Args:
+        classes: Class names or index strings
+        names: Dictionary of class index to name
+    
+    Returns:
+        Set of class indices
+    """
+    name_to_id = {name: index for index, name in names.items()}
+    class_ids = set()
+    for cls in classes:
+        if cls.isdigit() and int(cls) in names:
+            class_ids.add(int(cls))
+        elif cls in name_to_id:
+            class_ids.add(name_to_id[cls])
+        else:
+            print(f"Warning: unknown class {cls!r}")
+    return class_ids
+
+
+class VideoStream:
+    """
+    One video source with its own capture thread, gate, smoothing and output state.
+    """
+    
+    def __init__(self, source, index=None, max_frames=1):
+        self.source = source
+        self.index = index  # None when this is the only stream
+        self.max_frames = max_frames  # Frames taken per loop iteration
+        self.cap = None
+        self.capture = None
+        self.gate = None
+        self.output_writer = None
+        self.clip_writer = None
+        self.clip_class_ids = None
+        self.subtitles = None
+        self.mux_subtitles = False
+        self.annotation_pool = None
+        self.width = 0
+        self.height = 0
+        self.fps = 0
+        
+        # Last prediction, its filtered top-k and this stream's row in the shared temporal filter state
+        self.results = None
+        self.top = None
+        self.latency_ms = float("nan")
+        self.filter_row = None
+        self.filtered = False
+        self.frame_status = None
+        
+        # Variables for FPS calculation
+        self.frame_count = 0
+        self.start_time = time.time()
+        self.fps_display = 0
+    
+    @property
+    def label(self):
+        """Short name used in window titles and messages."""
+        return "" if self.index is None else f" [{self.source}]"
+    
+    def open(self, args):
+        """
+        Open the source, start its capture thread and create its outputs.
+        
+        Args:
+            args: Parsed command line arguments
+        
+        Returns:
+            True if the stream is ready to deliver frames
+        """
+        print(f"Opening video source: {self.source}...")
+        self.cap = cv2.VideoCapture(self.source)
+        
+        if not self.cap.isOpened():
+            print(f"Error: Could not open video source {self.source}")
+            return False
+        
+        # Keep the driver queue short so the freshest frame is never far behind
+        if args.latest_only and isinstance(self.source, int):
+            self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        
+        # Start the capture thread that decodes into preallocated buffers
+        num_buffers = max(args.capture_buffers, self.max_frames + 1)
+        self.capture = CaptureThread(self.cap, num_buffers, latest_only=args.latest_only,
+                                     preview=not args.headless)
+        if self.capture.ring is None:
+            print(f"Error: Failed to read frame{self.label}")
+            self.cap.release()
+            return False
+        self.capture.start()
+        
+        # Get video properties
+        self.height, self.width = self.capture.ring.frames[0].shape[:2]
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        
+        # Annotated frames are drawn into reusable buffers
+        self.annotation_pool = BufferPool(self.capture.ring.frames[0].shape)
+        
+        # Scene-change gate for skipping redundant inference
+        if args.gate_threshold > 0:
+            self.gate = SceneChangeGate(args.gate_threshold, frozen_frames=args.frozen_frames)
+        
+        # Create output video writer if saving is enabled
+        if args.save:
+            suffix = "" if self.index is None else f"_{self.index}"
+            output_path = f"output_{Path(args.model).stem}{suffix}_{time.strftime('%Y%m%d_%H%M%S')}.mp4"
+            if args.segment_seconds > 0 or args.segment_mb > 0:
+                # Segments are named after output_path with a running number
+                writer = SegmentedVideoWriter(
+                    output_path,
+                    lambda path: open_video_writer(path, self.width, self.height, self.fps, args),
+                    self.fps if self.fps > 0 else 30.0,
+                    args.segment_seconds,
+                    int(args.segment_mb * 1e6),
+                )
+                output_path = f"{Path(output_path).stem}_NNNN.mp4"
             else:
-                smoothed_probs = alpha * smoothed_probs + (1 - alpha) * current_probs
-                
-                # Update the results with smoothed probabilities
-                results[0].probs.data = torch.from_numpy(smoothed_probs).to(results[0].probs.data.device)
+                writer = open_video_writer(output_path, self.width, self.height, self.fps, args)
+            
+            # Encode on a background thread, the written buffers go back to the annotation pool
+            self.output_writer = AsyncVideoWriter(writer, args.writer_queue, args.writer_policy,
+                                                  args.keyframe_interval, pool=self.annotation_pool)
+            print(f"Saving output to: {output_path}")
+        
+        # Predictions as a subtitle track, so the video itself needs no output encoding
+        if args.subtitles:
+            suffix = "" if self.index is None else f"_{self.index}"
+            subtitle_path = f"output_{Path(args.model).stem}{suffix}_{time.strftime('%Y%m%d_%H%M%S')}.{args.subtitles}"
+            self.subtitles = SubtitleWriter(subtitle_path, args.subtitles,
+                                            1.0 / self.fps if self.fps > 0 else 1 / 30)
+            print(f"Writing subtitles to: {subtitle_path}")
+            self.mux_subtitles = args.mux_subtitles
+        
+        # Record clips around detections of the watched classes
+        if args.clip_classes:
+            suffix = "" if self.index is None else f"_{self.index}"
+            clip_path = f"output_{Path(args.model).stem}{suffix}_{time.strftime('%Y%m%d_%H%M%S')}.mp4"
+            recorder = ClipRecorder(
+                clip_path,
+                lambda path: open_video_writer(path, self.width, self.height, self.fps, args),
+                self.fps if self.fps > 0 else 30.0,
+                args.pre_roll,
+                args.post_roll,
+                args.clip_jpeg_quality,
+            )
+            self.clip_writer = AsyncVideoWriter(recorder, args.writer_queue, args.writer_policy,
+                                                args.keyframe_interval, pool=self.annotation_pool)
+        
+        return True
+    
+    def update_fps(self):
+        """Count a frame and refresh the FPS estimate once per second."""
+        self.frame_count += 1
+        elapsed_time = time.time() - self.start_time
+        if elapsed_time >= 1.0:  # Update FPS every second
+            self.fps_display = self.frame_count / elapsed_time
+            self.frame_count = 0
+            self.start_time = time.time()
+    
+    def needs_inference(self, frame):
+        """Run the scene-change gate and report frozen or blank sources."""
+        if self.gate is None:
+            return True
+        
+        run_inference = self.gate.update(frame) or self.results is None
+        status = "frozen" if self.gate.frozen else "blank" if self.gate.blank else None
+        if status != self.frame_status:
+            if status is not None:
+                print(f"Warning: video source{self.label} appears {status}")
+            self.frame_status = status
+        return run_inference
+    
+    def annotate(self, frame, top, args):
+        """
+        Draw the predictions and the FPS counter on a frame.
         
-        # Visualize the results on the frame
-        if args.custom_visualization:
-            annotated_frame = custom_visualization(frame, results, top_k=args.top_k)
+        Args:
+            frame: Original frame
+            top: (class indices, probabilities) from the temporal filter, or None
+            args: Parsed command line arguments
+        
+        Returns:
+            Annotated frame, a pool buffer to be handed back with annotation_pool.release()
+        """
+        # Visualize the results on the frame, the display may show frames before the first one
+        buffer = self.annotation_pool.acquire()
+        if self.results is None:
+            annotated_frame = buffer
+            np.copyto(annotated_frame, frame)
+        elif args.custom_visualization:
+            annotated_frame = custom_visualization(frame, self.results, top_k=args.top_k, top=top, out=buffer)
         else:
-            # For classification, we need to create our own visualization
-            annotated_frame = frame.copy()
+            annotated_frame = basic_visualization(frame, self.results, top_k=args.top_k, top=top, out=buffer)
+        
+        # Add FPS counter if enabled
+        if args.show_fps:
+            x = text_sprites.draw(annotated_frame, "FPS: ", (self.width - 150, 40), 1, (0, 255, 0), 2)
+            text_sprites.draw_number(annotated_frame, f"{self.fps_display:.1f}", (x, 40), 1, (0, 255, 0), 2)
+        
+        return annotated_frame
+    
+    def detects(self, classes, threshold):
+        """
+        Whether a watched class reaches the threshold in the current prediction.
+        
+        Args:
+            classes: Class names or indices from the command line
+            threshold: Minimum probability
+        
+        Returns:
+            True if any watched class is at or above the threshold
+        """
+        if self.results is None or self.results[0].probs is None:
+            return False
+        if self.clip_class_ids is None:
+            self.clip_class_ids = resolve_class_ids(classes, self.results[0].names)
+        
+        # Prefer the temporally filtered top-k, which is what the overlay shows
+        if self.top is not None:
+            indices, probs = self.top
+            return any(index in self.clip_class_ids and prob >= threshold for index, prob in zip(indices, probs))
+        data = self.results[0].probs.data
+        return any(float(data[index]) >= threshold for index in self.clip_class_ids)
+    
+    def close(self):
+        """Stop capturing and release the source and its writers."""
+        if self.capture is not None and not self.capture.stop():
+            # Releasing the capture under a blocked read could crash, leave it to process exit
+            print(f"Warning: capture thread{self.label} did not stop, source is stalled")
+        elif self.cap is not None:
+            self.cap.release()
+        if self.output_writer is not None:
+            self.output_writer.release()
+        if self.clip_writer is not None:
+            self.clip_writer.release()
+        if self.subtitles is not None:
+            self.subtitles.release()
             
-            # Get the probs from the first result
-            probs = results[0].probs
+            # Stream-copy the source video together with the finished subtitles
+            if self.mux_subtitles:
+                if isinstance(self.source, str):
+                    output_path = self.subtitles.path.with_suffix(".mkv")
+                    try:
+                        mux_subtitles(self.source, self.subtitles.path, output_path)
+                    except (OSError, RuntimeError) as e:
+                        # Cleanup must go on for the other streams, the subtitle file is still complete
+                        print(f"Warning: could not mux subtitles ({e}), keeping {self.subtitles.path}")
+                    else:
+                        print(f"Muxed subtitles into: {output_path}")
+                else:
+                    print(f"Warning: --mux-subtitles needs a video file, keeping {self.subtitles.path}")
+    
+    def print_stats(self, args):
+        """Print per-stream counters collected during the run."""
+        if self.capture is None or self.capture.ring is None:
+            return
+        if args.latest_only:
+            print(f"Dropped frames{self.label}: {self.capture.ring.dropped}")
+        if self.gate is not None:
+            print(f"Frames reusing the last prediction{self.label}: {self.gate.skipped}")
+        if self.output_writer is not None:
+            self.output_writer.print_stats(self.label)
+            if isinstance(self.output_writer.writer, SegmentedVideoWriter):
+                print(f"Recorded segments{self.label}: {self.output_writer.writer.segments}")
+        if self.clip_writer is not None:
+            print(f"Recorded clips{self.label}: {self.clip_writer.writer.clips}")
+
+
+def run_inference(streams, batcher, filter_bank, args, stop, predictions=None):
+    """
+    Classify frames from all streams until they end or stop is set.
+    
+    Args:
+        streams: Opened VideoStreams
+        batcher: MicroBatcher that runs the model
+        filter_bank: StreamFilterBank holding every stream's temporal filter row
+        args: Parsed command line arguments
+        stop: threading.Event that ends the loop when set
+        predictions: Optional PredictionSink that records every frame's prediction
+    """
+    # Every capture thread signals this event when it publishes a frame
+    frames_ready = threading.Event()
+    for stream in streams:
+        stream.capture.ring.ready = frames_ready
+    
+    active_streams = list(streams)
+    while active_streams and not stop.is_set():
+        # Take the frames every stream has already decoded and queue them for inference.
+        # Never wait on one stream, so a stalled source cannot hold up the others.
+        frames_ready.clear()
+        batch = []
+        finished_streams = []
+        for stream in list(active_streams):
+            for _ in range(stream.max_frames):
+                try:
+                    slot = stream.capture.ring.get(timeout=0)
+                except queue.Empty:
+                    break
+                
+                if slot is None:
+                    print(f"Error: Failed to read frame{stream.label}")
+                    active_streams.remove(stream)
+                    finished_streams.append(stream)
+                    break
+                
+                stream.update_fps()
+                frame = stream.capture.ring.frames[slot]
+                
+                # Skip inference when the scene has not changed
+                future = batcher.submit(frame) if stream.needs_inference(frame) else None
+                batch.append((stream, slot, frame, future, time.perf_counter()))
+        
+        # Block only when no stream had anything, in short steps so stop is noticed
+        if not batch and not finished_streams:
+            frames_ready.wait(0.1)
+            continue
+        
+        # Nothing else will be submitted this iteration
+        batcher.flush()
+        
+        # Split the batch into waves with at most one frame per stream, so the
+        # filter sees every stream's frames in order
+        waves = collections.defaultdict(list)
+        frames_seen = collections.Counter()
+        for item in batch:
+            waves[frames_seen[item[0]]].append(item)
+            frames_seen[item[0]] += 1
+        
+        for wave_index in sorted(waves):
+            wave = waves[wave_index]
+            
+            # Collect the YOLOv8 results of this wave
+            fresh = []
+            for stream, _, _, future, submitted in wave:
+                stream.latency_ms = float("nan")
+                if future is not None:
+                    result = future.result()
+                    stream.latency_ms = (time.perf_counter() - submitted) * 1000
+                    stream.results = [result]
+                    if result.probs is not None:
+                        fresh.append((stream.filter_row, result.probs.data))
+                        stream.filtered = True
             
-            if probs is not None:
-                # Get the top k class indices and their probabilities
-                top_indices = probs.top5[:args.top_k]
-                top_probs = probs.top5conf[:args.top_k]
+            # Apply temporal filtering to all fresh predictions in one update
+            if fresh:
+                filter_bank.update([row for row, _ in fresh], stack_probabilities([probs for _, probs in fresh]))
+            
+            # Top predictions of every stream in the wave, as decided by the filter
+            if filter_bank.filter.output is not None:
+                top_indices, top_probs = filter_bank.topk([item[0].filter_row for item in wave], args.top_k)
+            else:
+                top_indices = top_probs = [None] * len(wave)
+            
+            for (stream, slot, frame, _, _), indices, probs in zip(wave, top_indices, top_probs):
+                stream.top = (indices.tolist(), probs) if stream.filtered else None
+                
+                # Save the annotated frame if enabled, the writer returns the buffer to the pool
+                if stream.output_writer is not None:
+                    stream.output_writer.write(stream.annotate(frame, stream.top, args))
+                if stream.clip_writer is not None:
+                    # The trigger bypasses the writer queue, which may drop this frame
+                    if stream.detects(args.clip_classes, args.clip_threshold):
+                        stream.clip_writer.writer.trigger()
+                    stream.clip_writer.write(stream.annotate(frame, stream.top, args))
+                if stream.subtitles is not None:
+                    position = stream.capture.ring.positions[slot] / 1000
+                    stream.subtitles.add(position, format_predictions(stream.results, stream.top, args.top_k))
                 
-                # Get class names
-                class_names = results[0].names
+                # Record the prediction for offline analysis
+                if predictions is not None and stream.results is not None and stream.results[0].probs is not None:
+                    top = stream.top
+                    if top is None:
+                        top = topk_classes(stream.results[0].probs.data, args.top_k)
+                    predictions.add(stream.index or 0, stream.capture.ring.frame_numbers[slot],
+                                    stream.capture.ring.positions[slot] / 1000, top[0], top[1], stream.latency_ms)
                 
-                # Add each prediction
-                y_offset = 30
-                for i in range(len(top_indices)):
-                    class_idx = top_indices[i]
-                    prob = top_probs[i].item()
-                    class_name = class_names[class_idx]
-                    
-                    text = f"{class_name}: {prob:.2f}"
-                    cv2.putText(
-                        annotated_frame, 
-                        text, 
-                        (10, y_offset), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 
-                        0.7, 
-                        (0, 255, 0), 
-                        2
-                    )
-                    y_offset += 30
+                # Hand the buffer back to the capture thread
+                stream.capture.ring.release(slot)
         
-        # Add FPS counter if enabled
-        if args.show_fps:
-            cv2.putText(
-                annotated_frame, 
-                f"FPS: {fps_display:.1f}", 
-                (width - 150, 40), 
-                cv2.FONT_HERSHEY_SIMPLEX, 
-                1, 
-                (0, 255, 0), 
-                2
-            )
+        # Streams that ended give their filter rows back
+        for stream in finished_streams:
+            filter_bank.leave(stream.filter_row)
+
+
+def run_display(streams, args, stop):
+    """
+    Show the newest frame of every stream with its latest prediction.
+    
+    Frames come from each capture thread's preview mailbox rather than from
+    inference, so the window refreshes at up to --display-fps even when
+    inference is slower, reusing the last prediction, and inference never
+    waits for the GUI.
+    
+    Args:
+        streams: Opened VideoStreams
+        args: Parsed command line arguments
+        stop: threading.Event that ends the loop, also set when 'q' is pressed
+    """
+    refresh_period = 1.0 / args.display_fps
+    while not stop.is_set():
+        refresh_start = time.perf_counter()
+        for stream in streams:
+            frame = stream.capture.preview.take()
+            if frame is None:
+                continue
+            
+            # Display the annotated frame
+            annotated_frame = stream.annotate(frame, stream.top, args)
+            cv2.imshow(f"YOLOv8 Classification{stream.label}", annotated_frame)
+            stream.annotation_pool.release(annotated_frame)
         
-        # Display the annotated frame
-        cv2.imshow("YOLOv8 Classification", annotated_frame)
+        # Wait for the next refresh in waitKey, and stop if 'q' is pressed
+        remaining_ms = (refresh_period - (time.perf_counter() - refresh_start)) * 1000
+        if cv2.waitKey(max(1, int(remaining_ms))) & 0xFF == ord('q'):
+            stop.set()
+
+
+def main():
+    """Main function for real-time classification."""
+    # Parse arguments
+    args = parse_arguments()
+    
+    # Quantization is a separate tool mode
+    if args.quantize == "int8":
+        quantize_int8(args)
+        return
+    
+    # Load the model
+    print(f"Loading model: {args.model}...")
+    model = load_model(args)
+    
+    # Try a cheaper low-resolution pass before the full-resolution one
+    resolution_cascade = None
+    if args.low_res_imgsz > 0:
+        resolution_cascade = ResolutionCascade(model, args.low_res_imgsz, args.imgsz,
+                                               args.uncertainty, args.uncertainty_threshold)
+        model = resolution_cascade
+    
+    # Escalate low-confidence frames to a larger model
+    if args.cascade_model:
+        print(f"Loading cascade model: {args.cascade_model}...")
+        model = CascadeClassifier(model, load_model(args, args.cascade_model), args.conf)
+    
+    # Open webcams or video files
+    sources = []
+    for device in args.device:
+        try:
+            sources.append(int(device))  # Try to convert to integer for webcam index
+        except ValueError:
+            sources.append(device)  # Use as string path for video file
+    
+    # Frames per stream that may share one batch when they are already decoded
+    max_frames = 1 if args.latest_only else max(1, args.max_batch // len(sources))
+    streams = [VideoStream(source, index if len(sources) > 1 else None, max_frames)
+               for index, source in enumerate(sources)]
+    for stream in streams:
+        if not stream.open(args):
+            for opened in streams:
+                opened.close()
+            return
+    
+    # Temporal filter state for all streams in one (streams x classes) array
+    temporal_filter = create_temporal_filter(args.filter, args.smoothing, args.window, args.hysteresis_margin)
+    filter_bank = StreamFilterBank(temporal_filter, capacity=len(streams))
+    for stream in streams:
+        stream.filter_row = filter_bank.join()
+    
+    # Scheduler that batches frames across streams within a latency budget
+    batcher = MicroBatcher(model, args.max_batch, args.max_wait_ms / 1000)
+    
+    # Columnar log of every frame's prediction
+    predictions = None
+    if args.predictions:
+        predictions = PredictionSink(args.predictions, args.top_k, [stream.source for stream in streams],
+                                     args.predictions_row_group)
+        print(f"Saving predictions to: {args.predictions}")
+    
+    # Stop cleanly when interrupted or terminated by a process supervisor
+    stop = install_stop_handlers()
+    
+    if args.headless:
+        print("Starting classification. Press Ctrl+C to stop.")
+    else:
+        print("Starting classification. Press 'q' to quit.")
+    
+    # Main loop
+    if args.headless:
+        run_inference(streams, batcher, filter_bank, args, stop, predictions)
+    else:
+        # Inference runs in a worker thread, the GUI stays on the main thread
+        errors = []
         
-        # Save the frame if enabled
-        if output_writer is not None:
-            output_writer.write(annotated_frame)
+        def inference_worker():
+            try:
+                run_inference(streams, batcher, filter_bank, args, stop, predictions)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                stop.set()
         
-        # Break the loop if 'q' is pressed
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
+        worker = threading.Thread(target=inference_worker, daemon=True)
+        worker.start()
+        try:
+            run_display(streams, args, stop)
+        finally:
+            stop.set()
+            worker.join()
+        if errors:
+            raise errors[0]
     
     # Release resources
-    cap.release()
-    if output_writer is not None:
-        output_writer.release()
-    cv2.destroyAllWindows()
+    batcher.close()
+    for stream in streams:
+        stream.close()
+    if predictions is not None:
+        predictions.close()
+    if not args.headless:
+        cv2.destroyAllWindows()
     
+    for stream in streams:
+        stream.print_stats(args)
+    batcher.print_stats()
+    if predictions is not None:
+        predictions.print_stats()
+    if resolution_cascade is not None:
+        resolution_cascade.print_stats()
+    if isinstance(model, CascadeClassifier):
+        model.print_stats()
     print("Classification finished.")
 
 
 if __name__ == "__main__":
     try:
-        import torch  # Import torch for tensor operations
         main()
-    except ImportError:
-        print("Error: PyTorch is required for this script.")
-        print("Please install it with: pip install torch")
     except Exception as e:
         print(f"Error: {e}")
\ No newline at end of file
@@ -13,21 +13,31 @@ import time
 import numpy as np
 from ultralytics import YOLO
 from pathlib import Path
-import torch  # Import torch for tensor operations
+from classification_utils import (AsyncVideoWriter, BufferPool, FFmpegWriter, create_temporal_filter,
+                                  install_stop_handlers, text_sprites, topk_classes)
 
 # Configuration variables - modify these as needed
 MODEL = "yolov8n-cls.pt"  # Options: "yolov8n-cls.pt", "yolov8s-cls.pt", "yolov8m-cls.pt", "yolov8l-cls.pt", "yolov8x-cls.pt"
 DEVICE = 0  # Webcam index (usually 0 for built-in webcam)
 CONFIDENCE_THRESHOLD = 0.25  # Minimum confidence for predictions
+CASCADE_MODEL = None  # Larger model for frames below CONFIDENCE_THRESHOLD, e.g. "yolov8m-cls.pt"
 SAVE_VIDEO = False  # Set to True to save the output video
+FFMPEG_CODEC = None  # Encode with an ffmpeg subprocess instead of mp4v, e.g. "libx264" (needs ffmpeg)
+WRITER_QUEUE = 16  # Frames that may wait for the background video encoder
+WRITER_POLICY = "block"  # When the encoder falls behind: "block", "drop" or "keyframe"
+HEADLESS = False  # Set to True to run without a display window (stop with Ctrl+C or SIGTERM)
 SHOW_FPS = True  # Set to True to display FPS counter
 TOP_K = 3  # Number of top predictions to display
 CUSTOM_VISUALIZATION = True  # Set to True to use custom visualization
 SMOOTHING = True  # Set to True to enable temporal smoothing of predictions
-SMOOTHING_FACTOR = 0.7  # Smoothing factor (higher = more smoothing)
+SMOOTHING_FILTER = "ema"  # Options: "ema", "window", "vote", "hysteresis"
+SMOOTHING_FACTOR = 0.7  # Smoothing factor for "ema" and "hysteresis" (higher = more smoothing)
+SMOOTHING_WINDOW = 10  # Number of frames for "window" and "vote"
+HYSTERESIS_MARGIN = 0.1  # Probability lead a new label needs before "hysteresis" switches to it
+LATEST_ONLY = False  # Set to True to always classify the freshest frame and drop stale ones
 
 
-def custom_visualization(frame, results, top_k=3):
+def custom_visualization(frame, results, top_k=3, top=None, out=None):
     """
     Custom visualization of classification results.
     
@@ -35,39 +45,37 @@ def custom_visualization(frame, results, top_k=3):
         frame: Original frame
         results: YOLOv8 results
         top_k: Number of top predictions to display
+        top: Optional (class indices, probabilities) to show instead of the raw top-k
+        out: Optional preallocated buffer of the frame's shape to draw into
     
     Returns:
         Annotated frame with custom visualization
     """
-    # Create a copy of the original frame
-    annotated_frame = frame.copy()
+    # Copy the original frame, into the caller's buffer if one is given
+    if out is None:
+        annotated_frame = frame.copy()
+    else:
+        annotated_frame = out
+        np.copyto(annotated_frame, frame)
     
     # Get the probs from the first result
     probs = results[0].probs
     
     if probs is not None:
-        # Get the top k class indices and their probabilities
-        top_indices = probs.top5[:top_k]
-        top_probs = probs.top5conf[:top_k]
+        # Get the top k class indices and their probabilities in one pass
+        if top is None:
+            top = topk_classes(probs.data, top_k)
+        top_indices, top_probs = top[0][:top_k], top[1][:top_k]
         
         # Get class names
         class_names = results[0].names
         
-        # Create a semi-transparent overlay for the prediction area
-        overlay = annotated_frame.copy()
-        cv2.rectangle(overlay, (0, 0), (300, 30 + 30 * top_k), (0, 0, 0), -1)
-        cv2.addWeighted(overlay, 0.5, annotated_frame, 0.5, 0, annotated_frame)
+        # Darken the prediction area in place, blending only that region
+        roi = annotated_frame[:31 + 30 * top_k, :301]
+        cv2.addWeighted(roi, 0.5, roi, 0, 0, roi)
         
         # Add title
-        cv2.putText(
-            annotated_frame, 
-            "Top Predictions:", 
-            (10, 25), 
-            cv2.FONT_HERSHEY_SIMPLEX, 
-            0.7, 
-            (255, 255, 255), 
-            2
-        )
+        text_sprites.draw(annotated_frame, "Top Predictions:", (10, 25), 0.7, (255, 255, 255), 2)
         
         # Add each prediction
         for i in range(len(top_indices)):
@@ -83,17 +91,9 @@ def custom_visualization(frame, results, top_k=3):
             else:
                 color = (0, 0, 255)  # Red
             
-            # Add text
-            text = f"{i+1}. {class_name}: {prob:.2f}"
-            cv2.putText(
-                annotated_frame, 
-                text, 
-                (10, 55 + i * 30), 
-                cv2.FONT_HERSHEY_SIMPLEX, 
-                0.6, 
-                color, 
-                2
-            )
+            # Add text, with the probability drawn from the digit atlas
+            x = text_sprites.draw(annotated_frame, f"{i+1}. {class_name}: ", (10, 55 + i * 30), 0.6, color, 2)
+            text_sprites.draw_number(annotated_frame, f"{prob:.2f}", (x, 55 + i * 30), 0.6, color, 2)
             
             # Add confidence bar
             bar_length = int(200 * prob)
@@ -108,12 +108,46 @@ def custom_visualization(frame, results, top_k=3):
     return annotated_frame
 
 
+def read_latest(cap, frame_period):
+    """
+    Read the freshest frame, skipping frames that were already buffered.
+    
+    Args:
+        cap: Opened video capture
+        frame_period: Expected time between camera frames in seconds
+    
+    Returns:
+        Tuple of (success, frame, number of dropped frames)
+    """
+    # Buffered frames are returned immediately, a fresh one makes grab() wait
+    grab_start = time.perf_counter()
+    if not cap.grab():
+        return False, None, 0
+    
+    # Keep draining only while grabs come straight from the buffer
+    dropped = 0
+    while time.perf_counter() - grab_start <= frame_period / 2:
+        grab_start = time.perf_counter()
+        if not cap.grab():
+            break
+        dropped += 1
+    
+    success, frame = cap.retrieve()
+    return success, frame, dropped
+
+
 def main():
     """Main function for real-time classification."""
     # Load the model
     print(f"Loading model: {MODEL}...")
     model = YOLO(MODEL)
     
+    # Load the larger model for low-confidence frames
+    cascade_model = None
+    if CASCADE_MODEL:
+        print(f"Loading cascade model: {CASCADE_MODEL}...")
+        cascade_model = YOLO(CASCADE_MODEL)
+    
     # Open webcam
     print(f"Opening webcam at index: {DEVICE}...")
     cap = cv2.VideoCapture(DEVICE)
@@ -122,17 +156,29 @@ def main():
         print(f"Error: Could not open webcam at index {DEVICE}")
         return
     
+    # Keep the driver queue short so the freshest frame is never far behind
+    if LATEST_ONLY:
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    
     # Get video properties
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
     fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_period = 1.0 / fps if fps > 0 else 1.0 / 30
     
-    # Create output video writer if saving is enabled
+    # Annotated frames are drawn into reusable buffers
+    annotation_pool = BufferPool((height, width, 3))
+    
+    # Create output video writer if saving is enabled, encoding on a background thread
     output_writer = None
     if SAVE_VIDEO:
         output_path = f"output_{Path(MODEL).stem}_{time.strftime('%Y%m%d_%H%M%S')}.mp4"
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        output_writer = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+        if FFMPEG_CODEC:
+            writer = FFmpegWriter(output_path, width, height, fps if fps > 0 else 30.0, codec=FFMPEG_CODEC)
+        else:
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+            writer = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+        output_writer = AsyncVideoWriter(writer, WRITER_QUEUE, WRITER_POLICY, pool=annotation_pool)
         print(f"Saving output to: {output_path}")
     
     # Variables for FPS calculation
@@ -140,20 +186,46 @@ def main():
     start_time = time.time()
     fps_display = 0
     
-    # Variables for prediction smoothing
-    smoothed_probs = None
+    # Temporal filter for prediction smoothing
+    smoother = create_temporal_filter(SMOOTHING_FILTER, SMOOTHING_FACTOR, SMOOTHING_WINDOW, HYSTERESIS_MARGIN)
+    
+    # Frames skipped in latest-only mode, and when the first and last frames were read
+    dropped_frames = 0
+    frames_read = 0
+    first_read_time = last_read_time = 0.0
+    
+    # Cascade statistics: frames, escalations and time spent in each model
+    classified_frames = 0
+    escalated_frames = 0
+    small_model_time = 0.0
+    large_model_time = 0.0
+    
+    # Stop cleanly when interrupted or terminated by a process supervisor
+    stop = install_stop_handlers()
     
-    print("Starting classification. Press 'q' to quit.")
+    if HEADLESS:
+        print("Starting classification. Press Ctrl+C to stop.")
+    else:
+        print("Starting classification. Press 'q' to quit.")
     
     # Main loop
-    while cap.isOpened():
+    while cap.isOpened() and not stop.is_set():
         # Read a frame
-        success, frame = cap.read()
+        if LATEST_ONLY:
+            success, frame, dropped = read_latest(cap, frame_period)
+            dropped_frames += dropped
+        else:
+            success, frame = cap.read()
         
         if not success:
             print("Error: Failed to read frame")
             break
         
+        frames_read += 1
+        last_read_time = time.perf_counter()
+        if frames_read == 1:
+            first_read_time = last_read_time
+        
         # Update FPS calculation
         frame_count += 1
         elapsed_time = time.time() - start_time
@@ -163,37 +235,48 @@ def main():
             start_time = time.time()
         
         # Run YOLOv8 inference
+        inference_start = time.time()
         results = model(
             frame, 
             verbose=False
         )
+        small_model_time += time.time() - inference_start
+        classified_frames += 1
+        
+        # Re-run uncertain frames on the larger model
+        if (cascade_model is not None and results[0].probs is not None
+                and results[0].probs.top1conf.item() < CONFIDENCE_THRESHOLD):
+            inference_start = time.time()
+            results = cascade_model(
+                frame, 
+                verbose=False
+            )
+            large_model_time += time.time() - inference_start
+            escalated_frames += 1
         
         # Apply temporal smoothing to predictions
+        top = None
         if SMOOTHING and results[0].probs is not None:
-            current_probs = results[0].probs.data.cpu().numpy()
-            
-            if smoothed_probs is None:
-                smoothed_probs = current_probs
-            else:
-                smoothed_probs = SMOOTHING_FACTOR * smoothed_probs + (1 - SMOOTHING_FACTOR) * current_probs
-                
-                # Update the results with smoothed probabilities
-                results[0].probs.data = torch.from_numpy(smoothed_probs).to(results[0].probs.data.device)
+            # Update the results with smoothed probabilities
+            results[0].probs.data = smoother.update(results[0].probs.data)
+            top = smoother.topk(TOP_K)
         
         # Visualize the results on the frame
+        annotated_frame = annotation_pool.acquire()
         if CUSTOM_VISUALIZATION:
-            annotated_frame = custom_visualization(frame, results, top_k=TOP_K)
+            custom_visualization(frame, results, top_k=TOP_K, top=top, out=annotated_frame)
         else:
             # For classification, we need to create our own visualization
-            annotated_frame = frame.copy()
+            np.copyto(annotated_frame, frame)
             
             # Get the probs from the first result
             probs = results[0].probs
             
             if probs is not None:
-                # Get the top k class indices and their probabilities
-                top_indices = probs.top5[:TOP_K]
-                top_probs = probs.top5conf[:TOP_K]
+                # Get the top k class indices and their probabilities in one pass
+                if top is None:
+                    top = topk_classes(probs.data, TOP_K)
+                top_indices, top_probs = top[0][:TOP_K], top[1][:TOP_K]
                 
                 # Get class names
                 class_names = results[0].names
@@ -205,47 +288,53 @@ def main():
                     prob = top_probs[i].item()
                     class_name = class_names[class_idx]
                     
-                    text = f"{class_name}: {prob:.2f}"
-                    cv2.putText(
-                        annotated_frame, 
-                        text, 
-                        (10, y_offset), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 
-                        0.7, 
-                        (0, 255, 0), 
-                        2
-                    )
+                    x = text_sprites.draw(annotated_frame, f"{class_name}: ", (10, y_offset), 0.7, (0, 255, 0), 2)
+                    text_sprites.draw_number(annotated_frame, f"{prob:.2f}", (x, y_offset), 0.7, (0, 255, 0), 2)
                     y_offset += 30
         
         # Add FPS counter if enabled
         if SHOW_FPS:
-            cv2.putText(
-                annotated_frame, 
-                f"FPS: {fps_display:.1f}", 
-                (width - 150, 40), 
-                cv2.FONT_HERSHEY_SIMPLEX, 
-                1, 
-                (0, 255, 0), 
-                2
-            )
+            x = text_sprites.draw(annotated_frame, "FPS: ", (width - 150, 40), 1, (0, 255, 0), 2)
+            text_sprites.draw_number(annotated_frame, f"{fps_display:.1f}", (x, 40), 1, (0, 255, 0), 2)
         
         # Display the annotated frame
-        cv2.imshow("YOLOv8 Classification", annotated_frame)
+        if not HEADLESS:
+            cv2.imshow("YOLOv8 Classification", annotated_frame)
         
-        # Save the frame if enabled
+        # Save the frame if enabled, the writer returns the buffer to the pool
         if output_writer is not None:
             output_writer.write(annotated_frame)
+        else:
+            annotation_pool.release(annotated_frame)
         
         # Break the loop if 'q' is pressed
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+        if not HEADLESS and cv2.waitKey(1) & 0xFF == ord('q'):
             break
     
     # Release resources
     cap.release()
     if output_writer is not None:
         output_writer.release()
-    cv2.destroyAllWindows()
+    if not HEADLESS:
+        cv2.destroyAllWindows()
     
+    if LATEST_ONLY:
+        # The driver overwrites frames that arrive during inference without telling
+        # anyone, so estimate the drops from the camera's frame rate when it has one
+        if fps > 0 and frames_read > 0:
+            expected_frames = int(round((last_read_time - first_read_time) / frame_period)) + 1
+            dropped_frames = max(dropped_frames, expected_frames - frames_read)
+            print(f"Dropped frames: {dropped_frames} (estimated from the camera frame rate)")
+        else:
+            print(f"Dropped frames: at least {dropped_frames} (the camera reports no frame rate)")
+    if output_writer is not None:
+        output_writer.print_stats()
+    if cascade_model is not None and classified_frames > 0:
+        print(f"Cascade escalation rate: {escalated_frames / classified_frames:.1%} "
+              f"({escalated_frames}/{classified_frames} frames)")
+        print(f"Small model: {1000 * small_model_time / classified_frames:.1f} ms/frame")
+        if escalated_frames > 0:
+            print(f"Large model: {1000 * large_model_time / escalated_frames:.1f} ms/escalated frame")
     print("Classification finished.")
 
 
@@ -0,0 +1,771 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Classification helpers
+----------------------
+Pieces shared by classification.py and classification_simple.py: top-k
+selection, temporal filters, cached text overlays, buffer pooling, video
+writers and stop handling.
+"""
+
+import collections
+import cv2
+import queue
+import shutil
+import signal
+import subprocess
+import threading
+import time
+import numpy as np
+
+
+class BufferPool:
+    """
+    Reusable frame-sized buffers for annotated output.
+    
+    Buffers are taken with acquire() and handed back with release(). A new
+    buffer is only allocated when all existing ones are still in use, so
+    after warm-up annotating a frame allocates nothing.
+    """
+    
+    def __init__(self, shape, dtype=np.uint8):
+        self.shape = shape
+        self.dtype = dtype
+        self.allocated = 0
+        self._free = queue.Queue()
+    
+    def acquire(self):
+        """Take a free buffer, allocating one if the pool is empty."""
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            self.allocated += 1
+            return np.empty(self.shape, self.dtype)
+    
+    def release(self, buffer):
+        """Return a buffer that is no longer referenced."""
+        self._free.put(buffer)
+
+
+def topk_classes(probs, k):
+    """
+    Top-k class indices and probabilities in one pass, highest first.
+    
+    Only the k best entries are selected (np.argpartition) and sorted, instead
+    of sorting every class. Works along the last axis, so a batch of streams
+    is handled at once, and accepts torch tensors as well.
+    
+    Args:
+        probs: Probabilities, (num_classes,) or (streams, num_classes)
+        k: Number of classes to return, any value up to num_classes
+    
+    Returns:
+        Tuple of (indices, probabilities) NumPy arrays with k entries on the last axis
+    """
+    if not isinstance(probs, np.ndarray):
+        values, indices = probs.topk(min(k, probs.shape[-1]))
+        return indices.cpu().numpy(), values.float().cpu().numpy()
+    
+    k = min(k, probs.shape[-1])
+    indices = np.argpartition(probs, -k, axis=-1)[..., -k:]
+    values = np.take_along_axis(probs, indices, axis=-1)
+    order = np.argsort(-values, axis=-1)
+    return np.take_along_axis(indices, order, axis=-1), np.take_along_axis(values, order, axis=-1)
+
+
+def _row_index(rows):
+    """Use a slice for ascending contiguous rows so state is updated through a view."""
+    if len(rows) and rows[-1] - rows[0] == len(rows) - 1 and np.all(np.diff(rows) == 1):
+        return slice(int(rows[0]), int(rows[-1]) + 1)
+    return rows
+
+
+def _grown(array, capacity, axis=0):
+    """Copy of a NumPy array or torch tensor with one axis enlarged to capacity."""
+    shape = list(array.shape)
+    shape[axis] = capacity
+    grown = np.zeros(shape, dtype=array.dtype) if isinstance(array, np.ndarray) else array.new_zeros(shape)
+    grown[(slice(None),) * axis + (slice(0, array.shape[axis]),)] = array
+    return grown
+
+
+def stack_probabilities(probs):
+    """
+    Stack per-frame probability vectors into one float32 (frames, num_classes) NumPy array.
+    
+    Torch probabilities are copied to the host once for the whole batch.
+    """
+    if isinstance(probs[0], np.ndarray):
+        return np.stack(probs).astype(np.float32, copy=False)
+    
+    # Only reached with the ultralytics backend, which has already imported torch
+    import torch
+    return torch.stack(probs).float().cpu().numpy()
+
+
+class TemporalFilter:
+    """
+    Base class for temporal filters over class probabilities.
+    
+    The state of every stream lives in contiguous arrays with one row per
+    stream, such as (capacity, num_classes), so a batch of streams is filtered
+    with one vectorized operation. update(probs) filters a single stream held
+    in row 0, and update(probs, rows) filters a batch of shape
+    (len(rows), num_classes). Capacity grows geometrically when a row beyond
+    it is used.
+    """
+    
+    def __init__(self):
+        self.output = None  # Filtered probabilities, (capacity, num_classes)
+        self.counts = None  # Frames seen per row since it was last reset
+        self.capacity = 1
+    
+    def reserve(self, capacity):
+        """Make room for at least `capacity` rows."""
+        if capacity <= self.capacity:
+            return
+        capacity = max(capacity, 2 * self.capacity)
+        if self.output is not None:
+            self._grow(capacity)
+        self.capacity = capacity
+    
+    def reset(self, rows):
+        """Forget the history of the given rows, e.g. when a new stream takes them over."""
+        if self.counts is not None:
+            self.counts[rows] = 0
+    
+    def update(self, probs, rows=None):
+        """
+        Filter new probabilities.
+        
+        Args:
+            probs: (num_classes,) vector for row 0, or (len(rows), num_classes)
+            rows: State rows the probabilities belong to, each at most once
+        
+        Returns:
+            Filtered probabilities in the shape of probs
+        """
+        single = rows is None
+        if single:
+            rows = np.zeros(1, dtype=np.intp)
+            probs = probs[None]
+        else:
+            rows = np.asarray(rows, dtype=np.intp)
+        
+        self.reserve(int(rows.max()) + 1)
+        if self.output is None:
+            self.counts = np.zeros(self.capacity, dtype=np.int64)
+            self._allocate(probs)
+        
+        filtered = self._update(probs, rows, _row_index(rows))
+        self.counts[rows] += 1
+        return filtered[0] if single else filtered
+    
+    def topk(self, k, rows=None):
+        """
+        Top-k classes of the filtered probabilities.
+        
+        Returns:
+            Tuple of (class indices, probabilities), highest first. Without
+            rows this is a list and a vector for row 0, otherwise
+            (len(rows), k) arrays.
+        """
+        if self.output is None:
+            return [], np.empty(0, dtype=np.float32)
+        
+        single = rows is None
+        indices, values = topk_classes(self.output[[0] if single else list(rows)], k)
+        return (indices[0].tolist(), values[0]) if single else (indices, values)
+    
+    def _allocate(self, probs):
+        self.output = np.zeros((self.capacity, probs.shape[-1]), dtype=np.float32)
+    
+    def _grow(self, capacity):
+        self.output = _grown(self.output, capacity)
+        self.counts = _grown(self.counts, capacity)
+    
+    def _update(self, probs, rows, index):
+        raise NotImplementedError
+    
+    @staticmethod
+    def _as_numpy(probs):
+        return probs if isinstance(probs, np.ndarray) else probs.float().cpu().numpy()
+
+
+class EMAFilter(TemporalFilter):
+    """
+    Exponential moving average of class probabilities, updated in place.
+    
+    The state is allocated as the same array type and on the same device as
+    the first probabilities it sees, so a single stream filtered with
+    update(probs) keeps ultralytics' torch probabilities on their device. The
+    batched StreamFilterBank path works on one host NumPy array per wave,
+    built by stack_probabilities().
+    """
+    
+    def __init__(self, alpha=0.7):
+        super().__init__()
+        self.alpha = alpha  # Smoothing factor (higher = more smoothing)
+    
+    def _allocate(self, probs):
+        if isinstance(probs, np.ndarray):
+            super()._allocate(probs)
+        else:
+            self.output = probs.new_zeros((self.capacity, probs.shape[-1]))
+    
+    def _update(self, probs, rows, index):
+        state = self.output[index]
+        
+        # alpha * state + (1 - alpha) * probs without temporaries
+        state -= probs
+        state *= self.alpha
+        state += probs
+        
+        # Rows without history start from their first prediction
+        fresh = np.flatnonzero(self.counts[rows] == 0).tolist()
+        if fresh:
+            state[fresh] = probs[fresh]
+        
+        if not isinstance(index, slice):
+            self.output[index] = state
+        return state
+
+
+class WindowMeanFilter(TemporalFilter):
+    """Mean of the last `window` probability vectors, kept in a (window, rows, classes) ring buffer."""
+    
+    def __init__(self, window=10):
+        super().__init__()
+        self.window = window
+    
+    def _allocate(self, probs):
+        super()._allocate(probs)
+        self._ring = np.zeros((self.window,) + self.output.shape, dtype=np.float32)
+        self._sum = np.zeros(self.output.shape, dtype=np.float64)
+        self._positions = np.zeros(self.capacity, dtype=np.intp)
+    
+    def _grow(self, capacity):
+        super()._grow(capacity)
+        self._ring = _grown(self._ring, capacity, axis=1)
+        self._sum = _grown(self._sum, capacity)
+        self._positions = _grown(self._positions, capacity)
+    
+    def reset(self, rows):
+        super().reset(rows)
+        if self.output is not None:
+            self._sum[rows] = 0
+            self._positions[rows] = 0
+    
+    def _update(self, probs, rows, index):
+        probs = self._as_numpy(probs)
+        positions = self._positions[rows]
+        
+        # Replace the oldest entry and keep a running sum instead of re-reducing the ring
+        oldest = self._ring[positions, rows]
+        oldest[self.counts[rows] < self.window] = 0
+        sums = self._sum[index]
+        sums -= oldest
+        sums += probs
+        if not isinstance(index, slice):
+            self._sum[index] = sums
+        
+        self._ring[positions, rows] = probs
+        self._positions[rows] = (positions + 1) % self.window
+        
+        counts = np.minimum(self.counts[rows] + 1, self.window)
+        self.output[index] = sums / counts[:, None]
+        return self.output[index]
+
+
+class MajorityVoteFilter(TemporalFilter):
+    """
+    Majority vote over the top-1 class of the last `window` frames.
+    
+    The output holds each class's share of the votes, so top-k ranks classes
+    by how often they won within the window.
+    """
+    
+    def __init__(self, window=10):
+        super().__init__()
+        self.window = window
+    
+    def _allocate(self, probs):
+        super()._allocate(probs)
+        self._labels = np.zeros((self.window, self.capacity), dtype=np.intp)
+        self._votes = np.zeros(self.output.shape, dtype=np.int32)
+        self._positions = np.zeros(self.capacity, dtype=np.intp)
+    
+    def _grow(self, capacity):
+        super()._grow(capacity)
+        self._labels = _grown(self._labels, capacity, axis=1)
+        self._votes = _grown(self._votes, capacity)
+        self._positions = _grown(self._positions, capacity)
+    
+    def reset(self, rows):
+        super().reset(rows)
+        if self.output is not None:
+            self._votes[rows] = 0
+            self._positions[rows] = 0
+    
+    def _update(self, probs, rows, index):
+        probs = self._as_numpy(probs)
+        positions = self._positions[rows]
+        
+        # Retire the votes that fall out of the window, then cast the new ones
+        full = self.counts[rows] >= self.window
+        self._votes[rows[full], self._labels[positions[full], rows[full]]] -= 1
+        labels = probs.argmax(axis=1)
+        self._votes[rows, labels] += 1
+        self._labels[positions, rows] = labels
+        self._positions[rows] = (positions + 1) % self.window
+        
+        counts = np.minimum(self.counts[rows] + 1, self.window)
+        self.output[index] = self._votes[index] / counts[:, None]
+        return self.output[index]
+
+
+class HysteresisFilter(TemporalFilter):
+    """
+    Label switching with hysteresis on top of another filter.
+    
+    The reported top-1 class only changes when a challenger beats the current
+    class by more than `margin`, so near-ties do not flicker between labels.
+    Probabilities are passed through from the inner filter unchanged.
+    """
+    
+    def __init__(self, margin=0.1, inner=None):
+        super().__init__()
+        self.margin = margin
+        self.inner = inner or EMAFilter()
+    
+    def _allocate(self, probs):
+        super()._allocate(probs)
+        self.labels = np.full(self.capacity, -1, dtype=np.intp)
+    
+    def _grow(self, capacity):
+        super()._grow(capacity)
+        old_capacity = len(self.labels)
+        self.labels = _grown(self.labels, capacity)
+        self.labels[old_capacity:] = -1
+    
+    def reserve(self, capacity):
+        super().reserve(capacity)
+        self.inner.reserve(capacity)
+    
+    def reset(self, rows):
+        super().reset(rows)
+        self.inner.reset(rows)
+        if self.output is not None:
+            self.labels[rows] = -1
+    
+    def _update(self, probs, rows, index):
+        filtered = self._as_numpy(self.inner.update(probs, rows))
+        self.output[index] = filtered
+        
+        stream_index = np.arange(len(rows))
+        held = self.labels[rows]
+        best = filtered.argmax(axis=1)
+        lead = filtered[stream_index, best] - filtered[stream_index, np.maximum(held, 0)]
+        self.labels[rows] = np.where((held < 0) | (lead > self.margin), best, held)
+        return filtered
+    
+    def topk(self, k, rows=None):
+        if self.output is None:
+            return super().topk(k, rows)
+        
+        # Put the held label first, followed by the best of the remaining classes
+        single = rows is None
+        rows = [0] if single else rows
+        probs = self.output[rows]
+        indices, _ = topk_classes(probs, k + 1)
+        held = self.labels[rows][:, None]
+        others = np.where(indices == held, -1, indices)
+        order = np.argsort(others == -1, axis=1, kind="stable")
+        others = np.take_along_axis(others, order, axis=1)[:, :max(k - 1, 0)]
+        indices = np.concatenate([held, others], axis=1)[:, :k]
+        values = np.take_along_axis(probs, indices, axis=1)
+        return (indices[0].tolist(), values[0]) if single else (indices, values)
+
+
+class StreamFilterBank:
+    """
+    Temporal filter state for many streams in one (streams x classes) array.
+    
+    Streams join by claiming a free row and leave by returning it. Rows are
+    reused, and the filter's arrays only grow (geometrically) when every row
+    is taken, so streams come and go without reallocating the state.
+    """
+    
+    def __init__(self, temporal_filter, capacity=8):
+        self.filter = temporal_filter
+        self.filter.reserve(capacity)
+        self._free_rows = list(range(self.filter.capacity - 1, -1, -1))
+    
+    def join(self):
+        """Claim a row for a new stream."""
+        if not self._free_rows:
+            old_capacity = self.filter.capacity
+            self.filter.reserve(old_capacity + 1)
+            self._free_rows = list(range(self.filter.capacity - 1, old_capacity - 1, -1))
+        row = self._free_rows.pop()
+        self.filter.reset([row])
+        return row
+    
+    def leave(self, row):
+        """Return a stream's row to the pool."""
+        self._free_rows.append(row)
+    
+    def update(self, rows, probs):
+        """Filter the probabilities of several streams in one vectorized update."""
+        return self.filter.update(probs, rows)
+    
+    def topk(self, rows, k):
+        """Top-k classes of several streams at once, as (len(rows), k) arrays."""
+        return self.filter.topk(k, rows)
+
+
+def create_temporal_filter(kind="ema", alpha=0.7, window=10, margin=0.1):
+    """
+    Create a temporal filter by name.
+    
+    Args:
+        kind: "ema", "window", "vote" or "hysteresis" (hysteresis over an EMA)
+        alpha: EMA smoothing factor (higher = more smoothing)
+        window: Number of frames for the window mean and majority vote
+        margin: Probability lead a new label needs before hysteresis switches to it
+    
+    Returns:
+        TemporalFilter instance
+    """
+    if kind == "ema":
+        return EMAFilter(alpha)
+    if kind == "window":
+        return WindowMeanFilter(window)
+    if kind == "vote":
+        return MajorityVoteFilter(window)
+    if kind == "hysteresis":
+        return HysteresisFilter(margin, EMAFilter(alpha))
+    raise ValueError(f"Unknown temporal filter: {kind}")
+
+
+TextSprite = collections.namedtuple("TextSprite", ["pixels", "mask", "inverse_alpha", "x_offset", "y_offset", "advance"])
+
+
+class TextSprites:
+    """
+    LRU cache of pre-rendered text for the overlays.
+    
+    cv2.putText rasterizes every glyph on every call, although the same class
+    names and titles are drawn frame after frame. Each distinct (text, scale,
+    color, thickness) is rendered once into a small sprite with an alpha mask,
+    which is then composited into the frame. Numbers are not rasterized at
+    all: they are assembled from an atlas of digit sprites and kept in a
+    separate cache, so they never evict the labels.
+    """
+    
+    def __init__(self, max_entries=512, font=cv2.FONT_HERSHEY_SIMPLEX):
+        self.max_entries = max_entries
+        self.font = font
+        self._labels = collections.OrderedDict()
+        self._numbers = collections.OrderedDict()
+        self._glyphs = {}
+        self._lock = threading.Lock()
+    
+    def draw(self, frame, text, org, scale, color, thickness):
+        """
+        Draw text like cv2.putText, from the sprite cache.
+        
+        Args:
+            frame: BGR image to draw on
+            text: Text to draw
+            org: Bottom-left corner of the text, as for cv2.putText
+            scale: Font scale
+            color: BGR color
+            thickness: Stroke thickness
+        
+        Returns:
+            X coordinate where text following this one should start
+        """
+        sprite = self._lookup(self._labels, (text, scale, tuple(color), thickness), self._render)
+        self._blit(frame, sprite, org)
+        return org[0] + sprite.advance
+    
+    def draw_number(self, frame, text, org, scale, color, thickness):
+        """
+        Draw a formatted number assembled from the digit atlas.
+        
+        Takes the same arguments and returns the same as draw().
+        """
+        sprite = self._lookup(self._numbers, (text, scale, tuple(color), thickness), self._assemble)
+        self._blit(frame, sprite, org)
+        return org[0] + sprite.advance
+    
+    def _lookup(self, cache, key, create):
+        with self._lock:
+            sprite = cache.get(key)
+            if sprite is not None:
+                cache.move_to_end(key)
+                return sprite
+            
+            sprite = create(*key)
+            cache[key] = sprite
+            if len(cache) > self.max_entries:
+                cache.popitem(last=False)
+            return sprite
+    
+    def _render(self, text, scale, color, thickness, repeat=1):
+        (width, height), baseline = cv2.getTextSize(text, self.font, scale, thickness)
+        pad = thickness
+        alpha = np.zeros((height + baseline + 2 * pad, width + 2 * pad), np.uint8)
+        cv2.putText(alpha, text, (pad, pad + height), self.font, scale, 255, thickness)
+        
+        # getTextSize adds the full stroke thickness to the pen advance
+        repeated_width = cv2.getTextSize(text * repeat, self.font, scale, thickness)[0][0]
+        advance = (repeated_width - thickness) / repeat
+        
+        pixels = np.empty(alpha.shape + (3,), np.uint8)
+        pixels[:] = color
+        mask = (alpha > 0).astype(np.uint8)
+        if np.all(alpha[mask > 0] == 255):
+            # Without anti-aliasing a masked copy is the whole composite
+            return TextSprite(pixels, mask, None, pad, pad + height, advance)
+        
+        # Premultiply by alpha, so compositing is one multiply and one add
+        alpha = cv2.merge([alpha] * 3)
+        cv2.multiply(pixels, alpha, pixels, scale=1 / 255)
+        return TextSprite(pixels, mask, 255 - alpha, pad, pad + height, advance)
+    
+    def _assemble(self, text, scale, color, thickness):
+        glyphs = []
+        for char in text:
+            key = (char, scale, color, thickness)
+            if key not in self._glyphs:
+                # Measure the advance over repeated glyphs to keep rounding small
+                self._glyphs[key] = self._render(char, scale, color, thickness, repeat=8)
+            glyphs.append(self._glyphs[key])
+        
+        # Composite the glyphs onto an empty sprite at their pen positions
+        pad = thickness
+        y_offset = max(glyph.y_offset for glyph in glyphs)
+        height = max(glyph.mask.shape[0] - glyph.y_offset for glyph in glyphs) + y_offset
+        advance = sum(glyph.advance for glyph in glyphs)
+        width = int(np.ceil(advance)) + 2 * pad + max(glyph.mask.shape[1] for glyph in glyphs)
+        blended = any(glyph.inverse_alpha is not None for glyph in glyphs)
+        pixels = np.zeros((height, width, 3), np.uint8)
+        mask = np.zeros((height, width), np.uint8)
+        inverse_alpha = np.full((height, width, 3), 255, np.uint8) if blended else None
+        x = pad
+        for glyph in glyphs:
+            x0 = int(round(x)) - glyph.x_offset
+            y0 = y_offset - glyph.y_offset
+            region = (slice(y0, y0 + glyph.mask.shape[0]), slice(x0, x0 + glyph.mask.shape[1]))
+            self._composite(pixels, glyph, x0, y0)
+            np.maximum(mask[region], glyph.mask, out=mask[region])
+            if blended:
+                cv2.multiply(inverse_alpha[region], glyph.inverse_alpha, inverse_alpha[region], scale=1 / 255)
+            x += glyph.advance
+        return TextSprite(pixels, mask, inverse_alpha, pad, y_offset, advance)
+    
+    def _blit(self, frame, sprite, org):
+        x0 = int(round(org[0])) - sprite.x_offset
+        y0 = int(round(org[1])) - sprite.y_offset
+        self._composite(frame, sprite, x0, y0)
+    
+    @staticmethod
+    def _composite(target, sprite, x0, y0):
+        # Clip the sprite placed at (x0, y0) to the target
+        height, width = sprite.mask.shape
+        left, top = max(x0, 0), max(y0, 0)
+        right, bottom = min(x0 + width, target.shape[1]), min(y0 + height, target.shape[0])
+        if left >= right or top >= bottom:
+            return
+        
+        region = target[top:bottom, left:right]
+        crop = (slice(top - y0, bottom - y0), slice(left - x0, right - x0))
+        if sprite.inverse_alpha is None:
+            cv2.copyTo(sprite.pixels[crop], sprite.mask[crop], region)
+        else:
+            # target = target * (1 - alpha) + color * alpha
+            cv2.multiply(region, sprite.inverse_alpha[crop], region, scale=1 / 255)
+            cv2.add(region, sprite.pixels[crop], region)
+
+
+# Shared by all streams, so each class name is rendered once per run
+text_sprites = TextSprites()
+
+
+class FFmpegWriter:
+    """
+    Video writer that pipes raw BGR frames into an ffmpeg subprocess.
+    
+    ffmpeg's encoders give much smaller files than mp4v at the same quality
+    and CPU cost. Frames are written to the pipe straight from their buffers;
+    when the output resolution differs they are first resized into a single
+    preallocated buffer.
+    """
+    
+    def __init__(self, path, width, height, fps, codec="libx264", preset="veryfast", crf=23,
+                 threads=0, output_size=None, output_fps=0):
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is None:
+            raise RuntimeError("ffmpeg is required for --writer ffmpeg. "
+                               "Please install it, e.g. with: apt install ffmpeg")
+        
+        # Frames are resized before the pipe, so ffmpeg only sees the output size
+        self.output_size = output_size or (width, height)
+        self._buffer = None
+        if self.output_size != (width, height):
+            self._buffer = np.empty((self.output_size[1], self.output_size[0], 3), np.uint8)
+        
+        command = [ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+                   "-f", "rawvideo", "-pix_fmt", "bgr24",
+                   "-s", f"{self.output_size[0]}x{self.output_size[1]}", "-framerate", str(fps), "-i", "-"]
+        if output_fps > 0:
+            command += ["-r", str(output_fps)]
+        command += ["-c:v", codec]
+        if preset:
+            command += ["-preset", preset]
+        if crf >= 0:
+            command += ["-crf", str(crf)]
+        if threads > 0:
+            command += ["-threads", str(threads)]
+        command += ["-pix_fmt", "yuv420p", str(path)]
+        
+        # A buffered pipe writes every byte of a frame, retrying short writes.
+        # Frames are larger than its buffer and go through without a copy.
+        # Its own session keeps Ctrl+C away from ffmpeg, it finishes when stdin closes
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, start_new_session=True)
+    
+    def write(self, frame):
+        """Send one frame to the encoder."""
+        if self._buffer is not None:
+            frame = cv2.resize(frame, self.output_size, dst=self._buffer, interpolation=cv2.INTER_AREA)
+        self._process.stdin.write(memoryview(np.ascontiguousarray(frame)).cast("B"))
+    
+    def release(self):
+        """Close the pipe and wait for ffmpeg to finish the file."""
+        if self._process.stdin.closed:
+            return
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self._process.wait() != 0:
+            print(f"Error: ffmpeg exited with code {self._process.returncode}")
+
+
+class AsyncVideoWriter:
+    """
+    Encodes frames on a background thread fed by a bounded queue.
+    
+    write() hands the frame over and returns at once, so encoding no longer
+    adds to the per-frame latency. When the encoder falls behind, the policy
+    decides what happens: "block" waits for room, "drop" discards the frame,
+    and "keyframe" keeps only every keyframe_interval-th frame while the
+    queue is at least half full, waiting for room for those.
+    """
+    
+    def __init__(self, writer, max_queue=16, policy="block", keyframe_interval=30, pool=None):
+        self.writer = writer
+        self.policy = policy
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.pool = pool  # Written and dropped frames are handed back here
+        self.written = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.error = None
+        self._drop_lock = threading.Lock()
+        self._submitted = 0
+        self._depth_total = 0
+        self._encode_time = 0.0
+        self._closed = False
+        self._queue = queue.Queue(maxsize=max(1, max_queue))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def write(self, frame):
+        """Queue a frame for encoding. The writer owns the frame from now on."""
+        index = self._submitted
+        self._submitted += 1
+        depth = self._queue.qsize()
+        self._depth_total += depth
+        self.max_depth = max(self.max_depth, depth)
+        
+        if self.policy == "keyframe" and depth >= self._queue.maxsize // 2 and index % self.keyframe_interval:
+            self._drop(frame)
+        elif self.policy == "drop":
+            try:
+                self._queue.put_nowait(frame)
+            except queue.Full:
+                self._drop(frame)
+        else:
+            self._queue.put(frame)
+    
+    def release(self):
+        """Encode the queued frames, then stop the thread and release the writer."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self.writer.release()
+    
+    def print_stats(self, label=""):
+        """Print queue depth, dropped frames and encoder throughput."""
+        if self._submitted == 0:
+            return
+        print(f"Writer{label}: {self.written} frames written, {self.dropped} dropped, "
+              f"mean queue depth: {self._depth_total / self._submitted:.1f}, max queue depth: {self.max_depth}")
+        if self._encode_time > 0:
+            print(f"Writer throughput{label}: {self.written / self._encode_time:.1f} frames/s")
+    
+    def _drop(self, frame):
+        self._count_drop()
+        if self.pool is not None:
+            self.pool.release(frame)
+    
+    def _count_drop(self):
+        with self._drop_lock:
+            self.dropped += 1
+    
+    def _run(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                break
+            
+            # After an encoder failure keep draining, so write() never blocks forever
+            if self.error is None:
+                encode_start = time.perf_counter()
+                try:
+                    self.writer.write(frame)
+                except Exception as e:
+                    self.error = e
+                    print(f"Error: video writer failed: {e}")
+                else:
+                    self.written += 1
+                self._encode_time += time.perf_counter() - encode_start
+            if self.error is not None:
+                self._drop(frame)
+            elif self.pool is not None:
+                self.pool.release(frame)
+
+
+def install_stop_handlers():
+    """
+    Turn SIGINT and SIGTERM into a stop request, so the main loop can finish
+    its current frames and release every resource before exiting.
+    
+    Returns:
+        threading.Event that is set once a signal arrives
+    """
+    stop = threading.Event()
+    
+    def request_stop(signum, frame):
+        print(f"Received {signal.Signals(signum).name}, stopping...")
+        stop.set()
+    
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, request_stop)
+    return stop